@@ -2,13 +2,22 @@
 import logging
 from datetime import datetime
 from core_tcp import RobustTCPClient
+from frame_stream import FrameStream, AsyncFrameStream
+from decode_plan import DecodePlan, BitPlan
 
 logger = logging.getLogger("Proto")
 
+B1_FRAME_LEN = 93
+B3_FRAME_LEN = 37
+
 class AmpinvtProtocol:
     def __init__(self, tcp_client: RobustTCPClient, debug: bool = False):
         self.transport = tcp_client
         self.debug = debug
+        self.stream = FrameStream(tcp_client, debug=debug)
+        self._plans = {}
+        self._memo = {}       # (unit_id, id(plan)) -> 區段記憶
+        self._last_memo = {}  # unit_id -> 最近一次使用的記憶
 
     def _calc_checksum(self, data: bytes) -> int:
         return sum(data) & 0xFF
@@ -33,25 +42,39 @@ class AmpinvtProtocol:
             
         return True
 
-    def read_b1_data(self, unit_id: int):
-        req = bytearray([unit_id, 0xB1, 0x01, 0x00, 0x00, 0x00, 0x00])
-        req.append(self._calc_checksum(req))
-        if self.debug: logger.debug(f"TX [{unit_id}] Read: {req.hex(' ')}")
-        if not self.transport.send(req): return None
-        resp = self.transport.recv_fixed(93)
+    # 🔥 讀取共用：B1 (93 bytes 完整資料) / B3 (37 bytes 僅即時數據) 只差在命令碼與回應長度
+    def _read_frame(self, unit_id: int, cmd: int, length: int):
+        req = self._read_request(unit_id, cmd)
+        # 分幀器已保證：表頭 = [unit_id, cmd]、長度正確、checksum 正確
+        resp = self.stream.request(req, unit_id, (cmd,), length)
         if self.debug and resp: logger.debug(f"RX [{unit_id}]: {resp.hex(' ')}")
-        if not resp or len(resp) != 93: return None
-        if self._calc_checksum(resp[:-1]) != resp[-1]: return None
         return resp
 
-    def write_c0_command(self, unit_id: int, control_code: int) -> bool:
-        req = bytearray([unit_id, 0xC0, control_code, 0x00, 0x00, 0x00, 0x00])
+    def _read_request(self, unit_id: int, cmd: int) -> bytearray:
+        req = bytearray([unit_id, cmd, 0x01, 0x00, 0x00, 0x00, 0x00])
+        req.append(self._calc_checksum(req))
+        if self.debug: logger.debug(f"TX [{unit_id}] Read {cmd:02X}: {req.hex(' ')}")
+        return req
+
+    def read_b1_data(self, unit_id: int):
+        return self._read_frame(unit_id, 0xB1, B1_FRAME_LEN)
+
+    # ⚡ 快速路徑：只拉即時數據 (PV/電池電壓、電流、溫度、發電量 + 狀態位元)
+    def read_b3_data(self, unit_id: int):
+        return self._read_frame(unit_id, 0xB3, B3_FRAME_LEN)
+
+    # ✍️ 寫入共用：送出後等 8 bytes 回應 (命令碼回顯或 0xEE 拒絕)；req 為 None 表示參數無效，不送
+    def _write(self, unit_id: int, cmd: int, req, label: str) -> bool:
+        if req is None: return False
         req.append(self._calc_checksum(req))
-        if self.debug: logger.info(f"TX [{unit_id}] Write C0: {req.hex(' ')}")
-        if not self.transport.send(req): return False
-        resp = self.transport.recv_fixed(8)
+        if self.debug: logger.info(f"TX [{unit_id}] {label}: {req.hex(' ')}")
+        resp = self.stream.request(req, unit_id, (cmd, 0xEE), 8)
         return self._verify_write_response(resp) # 🛡️ 套用嚴格驗證
 
+    def write_c0_command(self, unit_id: int, control_code: int) -> bool:
+        req = bytearray([unit_id, 0xC0, control_code, 0x00, 0x00, 0x00, 0x00])
+        return self._write(unit_id, 0xC0, req, "Write C0")
+
     # 🔥 修改：支援 val 傳入字串 "HH:MM"，並轉譯為 4 Byte BCD 下發給設備
     def write_d0_command(self, unit_id: int, code: int, val, scale: float, vbytes: list) -> bool:
         req = bytearray([unit_id, 0xD0, code, 0x00, 0x00, 0x00, 0x00])
@@ -66,7 +89,7 @@ class AmpinvtProtocol:
                 req[6] = m % 10   # 分個位
             except ValueError:
                 logger.error(f"❌ 無效的時間格式: {val}")
-                return False
+                req = None
         else:
             # 一般數字處理邏輯
             int_val = int(round(float(val) / scale))
@@ -76,57 +99,67 @@ class AmpinvtProtocol:
                 req[vbytes[0]] = (int_val >> 8) & 0xFF
                 req[vbytes[1]] = int_val & 0xFF
 
-        req.append(self._calc_checksum(req))
-        if self.debug: logger.info(f"TX [{unit_id}] Write D0: {req.hex(' ')}")
-        if not self.transport.send(req): return False
-        resp = self.transport.recv_fixed(8)
-        return self._verify_write_response(resp) # 🛡️ 套用嚴格驗證
+        return self._write(unit_id, 0xD0, req, "Write D0")
 
     def write_time_sync(self, unit_id: int, dt: datetime) -> bool:
         req = bytearray([unit_id, 0xDF, dt.year % 100, dt.month, dt.day, dt.hour, dt.minute])
-        req.append(self._calc_checksum(req))
-        if self.debug: logger.info(f"TX [{unit_id}] TimeSync: {req.hex(' ')}")
-        if not self.transport.send(req): return False
-        resp = self.transport.recv_fixed(8)
-        return self._verify_write_response(resp) # 🛡️ 套用嚴格驗證
+        return self._write(unit_id, 0xDF, req, "TimeSync")
 
-    # 🔥 修改：加入 bcd_time 攔截器，將 4 byte 解析回字串 "HH:MM"
-    def decode(self, raw_bytes, map_list, is_bits=False):
-        import struct
-        result = {}
-        if is_bits:
-            for key, info in map_list.items():
-                if info['byte'] < len(raw_bytes):
-                    is_on = bool((raw_bytes[info['byte']] >> info['bit']) & 0x01)
-                    result[key] = "ON" if is_on else "OFF"
-            return result
-            
-        for item in map_list:
-            key, off, ln, sc = item['key'], item['offset'], item['length'], item['scale']
-            if off + ln > len(raw_bytes): continue
-            chunk = raw_bytes[off : off + ln]
-            val = 0
-            try:
-                # 💡 時控解碼攔截點
-                if item.get("bcd_time") and ln == 4:
-                    h = chunk[0] * 10 + chunk[1]
-                    m = chunk[2] * 10 + chunk[3]
-                    result[key] = f"{h:02d}:{m:02d}"
-                    continue  # 直接跳到下一個點位，不執行後面的數字解析
-
-                if ln == 1: val = chunk[0]
-                elif ln == 2: val = struct.unpack('>h' if item.get('signed') else '>H', chunk)[0]
-                elif ln == 4: val = struct.unpack('>i' if item.get('signed') else '>I', chunk)[0]
-                
-                if item.get('map') and val in item['map']: 
-                    result[key] = item['map'][val]
-                else: 
-                    result[key] = round(val / sc, 2) if sc != 1 else val
-            except Exception as e:
-                if self.debug: logger.warning(f"解碼錯誤 {key}: {e}")
-                pass
-                
-        if "battery_voltage" in result and "charge_current" in result:
-             try: result["charge_power"] = round(result["battery_voltage"] * result["charge_current"], 1)
-             except: pass
-        return result
+    def config_changed(self, unit_id) -> bool:
+        """最近一次 decode(unit_id=...) 的設定區段是否有變 (沒記憶時視為有變)"""
+        memo = self._last_memo.get(unit_id)
+        return True if memo is None else memo.get('changed', True)
+
+    def precompile(self, *maps):
+        """啟動時把暫存器地圖編譯成解碼計畫 (list → DecodePlan，dict → BitPlan)"""
+        for m in maps:
+            if m: self._plan_for(m, None)
+
+    def _plan_for(self, map_list, frame_len):
+        # 以地圖物件 id 為 key；同時保留地圖參考，確保 id 不會被回收重用
+        key = (id(map_list), frame_len)
+        entry = self._plans.get(key)
+        if entry is None:
+            plan = BitPlan(map_list) if isinstance(map_list, dict) else DecodePlan(map_list, frame_len)
+            entry = self._plans[key] = (map_list, plan)
+        return entry[1]
+
+    # 🔥 解碼走預編譯計畫：一次 unpack_from + 查表，bcd_time 4 byte 解析回字串 "HH:MM"
+    # 🔥 傳入 unit_id 時啟用區段記憶：設定區段 bytes 沒變就沿用上一幀的結果
+    def decode(self, raw_bytes, map_list, is_bits=False, unit_id=None):
+        if is_bits: return self._plan_for(map_list, None).decode(raw_bytes)
+        plan = self._plan_for(map_list, None)
+        if len(raw_bytes) < plan.size:
+            # 短封包：只解得到的欄位 (另編一份對應長度的計畫)
+            plan = self._plan_for(map_list, len(raw_bytes))
+        memo = None
+        if unit_id is not None:
+            memo = self._memo.setdefault((unit_id, id(plan)), {})
+            self._last_memo[unit_id] = memo
+        try:
+            return plan.decode(raw_bytes, memo)
+        except Exception as e:
+            if self.debug: logger.warning(f"解碼錯誤: {e}")
+            return {}
+
+class AsyncAmpinvtProtocol(AmpinvtProtocol):
+    """
+    🌀 asyncio 版：封包組裝與解碼完全沿用，只有收發改走 AsyncFrameStream
+    read_b1_data / read_b3_data / write_* 回傳 coroutine，呼叫端 await 即可
+    """
+    def __init__(self, transport, debug: bool = False):
+        super().__init__(transport, debug=debug)
+        self.stream = AsyncFrameStream(transport, debug=debug)
+
+    async def _read_frame(self, unit_id: int, cmd: int, length: int):
+        req = self._read_request(unit_id, cmd)
+        resp = await self.stream.request(req, unit_id, (cmd,), length)
+        if self.debug and resp: logger.debug(f"RX [{unit_id}]: {resp.hex(' ')}")
+        return resp
+
+    async def _write(self, unit_id: int, cmd: int, req, label: str) -> bool:
+        if req is None: return False
+        req.append(self._calc_checksum(req))
+        if self.debug: logger.info(f"TX [{unit_id}] {label}: {req.hex(' ')}")
+        resp = await self.stream.request(req, unit_id, (cmd, 0xEE), 8)
+        return self._verify_write_response(resp)
@@ -0,0 +1,326 @@
+# 總線工作者：每個 Modbus 網關一條輪詢 + 指令執行緒 (或 asyncio task)
+import asyncio
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+from core_tcp import RobustTCPClient
+from core_tcp_async import AsyncTCPClient
+from ampinvt_proto import AmpinvtProtocol, AsyncAmpinvtProtocol
+from command_handler import CommandHandler
+from scheduler import PollScheduler
+from device_health import DeviceHealth
+from state_cache import StateCache
+import flow
+
+class BusWorker:
+    """
+    🚌 單一網關 (RS485 串口服務器) 的輪詢迴圈
+    🔥 每個網關各自一條 TCP 連線、排程器、故障隔離與指令處理；RS485 一次只能有一個請求，但不同網關互不等待，
+       總吞吐量隨網關數線性成長。
+    🔥 MQTT client 與 HAManager 由所有網關共用：主執行緒收 MQTT 指令，依 unit id 丟進對應 worker 的 inbox 並叫醒它，
+       指令只會插隊自己那條總線的輪詢。
+    🔥 輪詢迴圈 (_loop) 與指令處理都是流程 (flow.py)：排程、插隊、故障隔離的決策只寫一份，
+       執行緒版與 asyncio 版只差在由哪個驅動器執行 I/O。
+    """
+    TRANSPORT, PROTOCOL = RobustTCPClient, AmpinvtProtocol
+
+    def __init__(self, gw: dict, app_config: dict, rmap, ha_mgr, discovered: set, details: dict,
+                 snapshot=None, debug: bool = False):
+        self.name = f"{gw['host']}:{gw['port']}"
+        self.logger = logging.getLogger(f"Bus {self.name}")
+        self.rmap = rmap
+        self.ha_mgr = ha_mgr
+        self.discovered = discovered   # 共用：所有網關已發現的設備
+        self.details = details         # 共用：uid -> device_details
+        self.snapshot = snapshot
+        self.unit_ids = gw['unit_ids']
+        self.poll_interval = gw['poll_interval']
+        self.bus_gap = gw['delay_between_units']
+        self.unit_intervals = gw['unit_intervals']
+
+        sys_cfg = app_config['system']
+        bl_cfg = app_config['blacklist']
+        self.fail_threshold = bl_cfg['fail_threshold']
+        self.full_refresh_cycles = app_config['polling']['full_refresh_cycles']
+        # B3 地圖為空 (例如 en 尚未補齊) 時退回每輪完整 B1
+        self.use_b3 = bool(getattr(rmap, 'B3_REALTIME', None)) and self.full_refresh_cycles > 1
+
+        self.tcp = self.TRANSPORT(gw['host'], gw['port'], gw['timeout'],
+                                   min_timeout=gw['min_timeout'] if gw['adaptive_timeout'] else None)
+        self.protocol = self.PROTOCOL(self.tcp, debug=debug)
+        self.protocol.precompile(rmap.B1_INFO, getattr(rmap, 'B3_REALTIME', None), rmap.B3_STATUS_BITS)
+        # 🩺 故障隔離：指數退避 + 抖動，隔離期滿以短逾時半開探測
+        self.health = DeviceHealth(bl_cfg['isolation_time'], bl_cfg['long_delay'], self.fail_threshold,
+                                   bl_cfg['long_delay_threshold'], probe_timeout=gw['probe_timeout'])
+        # 指令准入：隔離中 = offline；隔離期滿但還沒成功讀到 = probing
+        self.cmd_handler = CommandHandler(self.protocol, ha_mgr, rmap, timezone_offset=sys_cfg.get('timezone_offset', 8),
+                                          debounce=app_config['polling']['command_debounce'],
+                                          health=self.health.state, probe_timeout=gw['probe_timeout'])
+        # ⏱️ Deadline 排程：各設備錯開在同一個週期內，各自依固定速率輪詢
+        self.scheduler = PollScheduler(self.poll_interval)
+        self.poll_counts = {}
+        self.unconfirmed = set()    # 規格來自快取、尚未被真實 B1 確認的設備
+        self.from_snapshot = set()  # 目前 HA 上是快照值的設備，第一次真實讀取要強制發佈
+
+        self.cache = None
+        if sys_cfg.get('cache_path') and os.path.isdir(os.path.dirname(sys_cfg['cache_path']) or '.'):
+            self.cache = StateCache(sys_cfg['cache_path'], self.name)
+
+        # 📥 主執行緒轉進來的指令；wake 叫醒閒置的迴圈，urgent 是輪詢的插隊旗標 (只給要立即執行的指令)
+        self.inbox = queue.Queue()
+        self.wake = threading.Event()
+        self.urgent = threading.Event()
+        self.consecutive_errors = 0
+        self._thread = None
+
+    def restore(self):
+        """啟動時：快取還原規格與退避進度、快照重送最後狀態、排入排程 (在主執行緒、worker 啟動前呼叫)"""
+        cached_units = self.cache.load() if self.cache else {}
+        # 🚀 不再逐台阻塞掃描：全部設備一開始就是「半開」，第一次輪詢以短逾時探測，
+        #    讀到的設備當場送 discovery，慢或不在線的交給退避機制在背景慢慢找
+        for idx, uid in enumerate(self.unit_ids):
+            self.health.add_unknown(uid)
+            cached = cached_units.get(uid)
+            if cached:
+                # 💾 快取裡已知失敗的設備沿用退避進度；有規格的先送 discovery (第一次真實讀取再確認)
+                if self.health.restore(uid, cached['fails'], cached['retry_in']):
+                    # 重啟前就已離線：先記下 offline，discovery 送出時才不會把它洗成 online
+                    self.ha_mgr.publish_device_availability(uid, "offline")
+                    self.ha_mgr.publish_connectivity_state(uid, False)
+                if cached.get('details'):
+                    with self.ha_mgr.devices_lock:
+                        self.details[uid] = cached['details']
+                        self.discovered.add(uid)
+                    self.unconfirmed.add(uid)
+                    self.ha_mgr.announce(uid, cached['details'])
+            self.scheduler.add(uid, self.unit_intervals.get(uid), offset=idx * self.poll_interval / len(self.unit_ids))
+
+        # 📸 有快照且 HA 已有實體的設備：立即重送最後狀態 (標註 snapshot_age 秒數)，MQTT 連上時由發佈佇列送出
+        for uid in (self.unit_ids if self.snapshot else []):
+            rec = self.snapshot.load(uid)
+            if not rec or uid not in self.discovered: continue
+            b1_at, b1, b3_at, b3 = rec
+            vals = self.protocol.decode(b1, self.rmap.B1_INFO, unit_id=uid)
+            bits = self.protocol.decode(b1, self.rmap.B3_STATUS_BITS, is_bits=True)
+            if self.use_b3 and b3 and b3_at > b1_at:
+                vals.update(self.protocol.decode(b3, self.rmap.B3_REALTIME, unit_id=uid))
+                bits = self.protocol.decode(b3, self.rmap.B3_STATUS_BITS, is_bits=True)
+            if not vals: continue
+            vals["snapshot_age"] = int(time.time() - max(b1_at, b3_at))
+            self.ha_mgr.publish_values(uid, vals, force=True)
+            self.ha_mgr.publish_bits(uid, bits, force=True)
+            self.from_snapshot.add(uid)
+        if self.from_snapshot: self.logger.info(f"📸 已從快照重送 {len(self.from_snapshot)} 台設備的最後狀態")
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"bus-{self.name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, topic: str, payload: str):
+        """主執行緒呼叫：指令排進 inbox 並叫醒等待；立即執行的指令才打斷進行中的輪詢"""
+        self.inbox.put((topic, payload))
+        # 防彈跳網域 (拖拉滑桿) 的中間值只會排隊，不值得中斷輪詢；到期時間由 _next_wake 的 cmd_due 處理
+        if not self.cmd_handler.debounced(topic): self.urgent.set()
+        self.wake.set()
+
+    def save(self):
+        if self.cache: self.cache.save({uid: self.details[uid] for uid in self.unit_ids if uid in self.details},
+                                       self.health.export())
+
+    def _process_commands(self):
+        count = 0
+        self.wake.clear()  # 先清再取，取完之後才到的指令會再次設起
+        self.urgent.clear()
+        while True:
+            try: topic, payload = self.inbox.get_nowait()
+            except queue.Empty: break
+            count += yield from self.cmd_handler.submit(topic, payload)
+        return count + (yield from self.cmd_handler.dispatch_due())
+
+    def _need_full(self, uid) -> bool:
+        return (not self.use_b3 or uid not in self.discovered or uid in self.unconfirmed
+                or uid in self.cmd_handler.force_full_refresh
+                or self.poll_counts.get(uid, 0) % self.full_refresh_cycles == 0
+                or not self.ha_mgr.get_last_state(uid, "state_b1"))
+
+    def poll_unit(self, uid):
+        need_full = self._need_full(uid)
+        raw_data = yield flow.call(self.protocol.read_b1_data if need_full else self.protocol.read_b3_data, uid)
+        return self._on_frame(uid, raw_data, need_full)
+
+    def _on_frame(self, uid, raw_data, need_full: bool) -> bool:
+        """處理一次輪詢讀到的封包 (B1 或 B3)：設備識別、快照、解碼、發佈"""
+        if not raw_data: raise Exception("Empty Data")
+        if need_full:
+            if uid not in self.discovered or uid in self.unconfirmed:
+                b_type = raw_data[8]; b_count = raw_data[10]; hw_max = round(struct.unpack('>H', raw_data[24:26])[0] / 100.0, 1)
+                if not 1 <= b_count <= 16: raise Exception("Invalid Data")
+                details = {"count": b_count, "type": b_type, "hw_max": hw_max}
+                if uid in self.unconfirmed:
+                    # 快取的規格必須由真實讀取確認，不同才更新實體範圍
+                    self.unconfirmed.discard(uid)
+                    if details != self.details.get(uid):
+                        self.logger.info(f"🔄 設備 #{uid} 規格與快取不同，更新 discovery")
+                        with self.ha_mgr.devices_lock: self.details[uid] = details
+                        self.ha_mgr.announce(uid, details)
+                else:
+                    self.logger.info(f"🎉 發現新上線設備 #{uid}！")
+                    t_str = self.rmap.B1_INFO[0].get('map', {}).get(b_type, str(b_type))
+                    self.logger.info(f"✅ 設備 #{uid} 識別成功: {t_str}, {b_count}S, Max {hw_max}A")
+                    with self.ha_mgr.devices_lock:
+                        self.details[uid] = details
+                        self.discovered.add(uid)
+                    self.ha_mgr.announce(uid, details)
+                    self.ha_mgr.publish_connectivity_state(uid, True)
+
+            if self.snapshot: self.snapshot.record(uid, raw_data, is_b1=True)
+            vals = self.protocol.decode(raw_data, self.rmap.B1_INFO, unit_id=uid)
+            bits = self.protocol.decode(raw_data, self.rmap.B3_STATUS_BITS, is_bits=True)
+            self.cmd_handler.force_full_refresh.discard(uid)
+            self.cmd_handler.live_b1.add(uid)
+            self.poll_counts[uid] = 1
+        else:
+            if self.snapshot: self.snapshot.record(uid, raw_data, is_b1=False)
+            # B3 只帶即時欄位，疊在上一份完整 B1 上，HA 模板才不會缺 key
+            vals = dict(self.ha_mgr.get_last_state(uid, "state_b1"))
+            vals.update(self.protocol.decode(raw_data, self.rmap.B3_REALTIME, unit_id=uid))
+            bits = self.protocol.decode(raw_data, self.rmap.B3_STATUS_BITS, is_bits=True)
+            self.poll_counts[uid] = self.poll_counts.get(uid, 0) + 1
+
+        # 恢復連線時強制完整發佈 (HA 端可能已因 expire_after 變成不可用)
+        recovered = self.health.success(uid)
+        # 快照值第一次被真實資料取代時也強制完整發佈 (去掉 snapshot_age，且不被死區擋下)
+        fresh = recovered or uid in self.from_snapshot
+        self.from_snapshot.discard(uid)
+        self.ha_mgr.publish_values(uid, vals, force=fresh, config_changed=fresh or self.protocol.config_changed(uid))
+        self.ha_mgr.publish_bits(uid, bits, force=fresh)
+
+        if recovered:
+            self.logger.info(f"✅ 設備 #{uid} 連線恢復")
+            self.ha_mgr.publish_device_availability(uid, "online")
+            self.ha_mgr.publish_connectivity_state(uid, True)
+        return True
+
+    def handle_failure(self, uid):
+        delay, went_offline = self.health.failure(uid)
+        if went_offline:
+            self.logger.error(f"❌ 設備 #{uid} 連續失敗 {self.fail_threshold} 次，標記為【離線】")
+            self.ha_mgr.publish_device_availability(uid, "offline")
+            self.ha_mgr.publish_connectivity_state(uid, False)
+        self.scheduler.defer(uid, delay)
+
+    def log_stats(self):
+        for uid, st in self.scheduler.stats().items():
+            if st['overruns']:
+                self.logger.warning(f"⏱️ 設備 #{uid} 設定週期 {st['interval']}s，實際 {st['avg_period']}s，累計 overrun {st['overruns']}")
+            else:
+                self.logger.debug(f"⏱️ 設備 #{uid} 設定週期 {st['interval']}s，實際 {st['avg_period']}s")
+        for uid, st in self.health.stats().items():
+            self.logger.debug(f"🩺 設備 #{uid} {st['state']}，連續失敗 {st['fails']} 次，{st['retry_in']}s 後探測")
+        for (uid, length), (srtt, rto) in self.tcp.rtt_stats().items():
+            self.logger.debug(f"📶 設備 #{uid} ({length}B) SRTT {srtt}s，逾時 {rto}s")
+
+    def _tick(self, now: float, any_success: bool):
+        """每輪的例行工作：健康判定、快取寫入、統計；回傳重置後的 any_success"""
+        if now >= self._health_tick:
+            self._health_tick = now + self.poll_interval
+            if any_success or self.health.isolated_count() < len(self.unit_ids):
+                self.consecutive_errors = 0
+            else:
+                self.consecutive_errors += 1
+                if self.consecutive_errors % 5 == 0:
+                    self.logger.warning(f"⚠️ 此網關所有設備皆無回應 ({self.consecutive_errors})")
+            any_success = False
+
+        if self.cache and now >= self._cache_tick:
+            self._cache_tick = now + 60
+            yield flow.blocking(self.save)
+
+        if now >= self._stats_tick:
+            self._stats_tick = now + 300
+            self.log_stats()
+        return any_success
+
+    def _next_wake(self, now: float, bus_free_at: float) -> float:
+        """下一台到期、健康判定、總線間隔與防彈跳指令到期中，最早該醒來的時間"""
+        next_due = self.scheduler.next_due_time()
+        wake_at = max(min(next_due if next_due is not None else now + self.poll_interval, self._health_tick), bus_free_at, now)
+        cmd_due = self.cmd_handler.next_dispatch()
+        if cmd_due is not None: wake_at = min(wake_at, max(cmd_due, now))
+        return wake_at
+
+    def run(self):
+        flow.run(self._loop())
+
+    def _loop(self):
+        """輪詢主迴圈 (流程)：指令插隊、排程、故障隔離都在這裡決定，I/O 交給引擎的驅動器"""
+        stream = self.protocol.stream
+        bus_free_at = 0.0
+        any_success = False
+        now = time.monotonic()
+        self._health_tick, self._stats_tick, self._cache_tick = now + self.poll_interval, now + 300, now + 60
+
+        while True:
+            try:
+                if (yield from self._process_commands()) > 0: bus_free_at = time.monotonic() + 0.2
+
+                now = time.monotonic()
+                wake_at = self._next_wake(now, bus_free_at)
+                if wake_at > now:
+                    # 等到下一台到期，或收到指令立即醒來
+                    yield flow.wait(self.wake, wake_at - now)
+                else:
+                    uid = self.scheduler.pop_due(now)
+                    if uid is not None:
+                        state = self.health.state(uid, now)
+                        # 全部隔離時也要走到 _tick，快取寫入與統計不能停
+                        if state == "offline": self.scheduler.complete(uid)
+                        else:
+                            if state == "probing": self.logger.info(f"🔄 嘗試聯繫設備 #{uid} ...")
+                            # 輪詢中收到指令：剩下的等待最多一個封包時間，讓指令先上總線
+                            stream.preempt = self.urgent
+                            # 半開探測：只給短逾時，死位址不再每次白等完整 timeout
+                            stream.timeout_cap = self.health.timeout_cap(uid)
+                            try:
+                                any_success |= yield from self.poll_unit(uid)
+                                self.scheduler.complete(uid)
+                            except Exception:
+                                if stream.preempted: self.scheduler.defer(uid, 0)  # 被指令插隊，不算失敗，指令處理完就重讀
+                                else: self.handle_failure(uid)
+                            finally:
+                                stream.preempt = None
+                                stream.timeout_cap = None
+                            bus_free_at = time.monotonic() + self.bus_gap
+
+                any_success = yield from self._tick(time.monotonic(), any_success)
+
+            except Exception as e:
+                self.logger.error(f"輪詢迴圈發生意外錯誤: {e}")
+                self.consecutive_errors += 1
+                yield flow.sleep(1)
+
+class AsyncBusWorker(BusWorker):
+    """
+    🌀 asyncio 版：每個網關一個 task，全部跑在同一個事件迴圈
+    🔥 等設備回應、總線間隔、指令防彈跳都是 await，不佔執行緒；網關再多也不必多開執行緒。
+    🔥 wake / urgent 為 asyncio.Event：等待中的排程與進行中的輪詢 (AsyncFrameStream) 收到指令都會立即讓路。
+    🔥 快取寫入 (fsync + os.replace) 由 flow.run_async 丟到 asyncio.to_thread，不卡住事件迴圈。
+    """
+    TRANSPORT, PROTOCOL = AsyncTCPClient, AsyncAmpinvtProtocol
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wake = asyncio.Event()
+        self.urgent = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """須在事件迴圈內呼叫"""
+        self._task = asyncio.get_running_loop().create_task(self.run(), name=f"bus-{self.name}")
+
+    async def run(self):
+        await flow.run_async(self._loop())
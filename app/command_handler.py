@@ -1,83 +1,275 @@
+import json
 import logging
 import time
 from datetime import datetime, timedelta, timezone
 
+import flow
+
 logger = logging.getLogger("CMD")
 
+# 要寫的值與設備現值相同：不必碰總線
+_NOOP = ()
+
 class CommandHandler:
+    """
+    🎛️ HA 指令 → 設備寫入
+    🔥 會碰總線的方法 (submit / dispatch_due / process_message / run_transaction) 都是流程 (generator)：
+       准入、探測、重送、回讀的決策只寫一份，由 BusWorker 以執行緒版或 asyncio 版驅動 (見 flow.py)。
+    """
+    # 拖拉滑桿會連發多則 set，這些網域只寫最後一個值
+    DEBOUNCE_DOMAINS = ("number", "select", "text")
+
     # 🟢 接收 rmap
-    def __init__(self, protocol, ha_mgr, rmap, timezone_offset=8):
+    def __init__(self, protocol, ha_mgr, rmap, timezone_offset=8, debounce: float = 0.4, max_hold: float = 2.0,
+                 health=None, probe_timeout: float = 0.5):
         self.protocol = protocol
         self.ha_mgr = ha_mgr
         self.rmap = rmap # 儲存
         self.tz_offset = timezone_offset
+        # 寫入後回讀失敗的設備，下一輪輪詢強制走完整 B1
+        self.force_full_refresh = set()
+        # 啟動後真的讀到過 B1 的設備；快照 / 快取還原的狀態不能當設定影子
+        self.live_b1 = set()
+        # 🎚️ 防彈跳：同一 (uid, key) 在 debounce 秒內沒有新值才寫入，最多延後 max_hold 秒
+        self.debounce = debounce
+        self.max_hold = max_hold
+        self._pending = {}  # topic -> [payload, 第一次收到, 最後一次收到]
+        self.coalesced = 0
+        # 🩺 指令准入：health(uid) 回傳 "online" / "probing" / "offline"；離線直接拒絕，探測中只給一次短逾時嘗試
+        self.health = health
+        self.probe_timeout = probe_timeout
+
+    def submit(self, topic: str, payload: str, now: float = None):
+        """收到 MQTT 指令：number/select/text 進防彈跳佇列 (後到的覆蓋先到的)，其餘立即執行；回傳立即執行的數量"""
+        if self._hold(topic, payload, now): return 0
+        yield from self.process_message(topic, payload)
+        return 1
+
+    def debounced(self, topic: str) -> bool:
+        """此 topic 是否走防彈跳 (不會立即寫入)"""
+        parts = topic.split('/')
+        return self.debounce > 0 and len(parts) >= 4 and parts[-4] in self.DEBOUNCE_DOMAINS
+
+    def _hold(self, topic: str, payload: str, now: float = None) -> bool:
+        """防彈跳網域的指令排進 _pending (同 topic 覆蓋)；回傳是否已排隊"""
+        if not self.debounced(topic): return False
+        parts = topic.split('/')
+        now = time.monotonic() if now is None else now
+        pending = self._pending.get(topic)
+        if pending:
+            self.coalesced += 1
+            logger.debug(f"🎚️ 合併指令 {parts[-2]}: {pending[0]} -> {payload}")
+            pending[0], pending[2] = payload, now
+        else: self._pending[topic] = [payload, now, now]
+        return True
+
+    def next_dispatch(self):
+        """最早一則防彈跳指令的到期時間 (monotonic)；沒有則回傳 None"""
+        if not self._pending: return None
+        return min(min(last + self.debounce, first + self.max_hold) for _, first, last in self._pending.values())
+
+    def dispatch_due(self, now: float = None):
+        """寫入已穩定 (debounce 內無新值) 或已等滿 max_hold 的指令；回傳執行數量"""
+        due = self._pop_due(now)
+        for topic, payload in due: yield from self.process_message(topic, payload)
+        return len(due)
+
+    def _pop_due(self, now: float = None) -> list:
+        if not self._pending: return []
+        now = time.monotonic() if now is None else now
+        due = [t for t, (_, first, last) in self._pending.items()
+               if now - last >= self.debounce or now - first >= self.max_hold]
+        return [(t, self._pending.pop(t)[0]) for t in due]
 
     def process_message(self, topic: str, payload: str):
         try:
-            parts = topic.split('/')
-            if len(parts) < 4: return
-            key, entity_base, domain = parts[-2], parts[-3], parts[-4]
-            try: uid = int(entity_base.split('_')[-1])
-            except: return
-
-            if domain == "switch": self._handle_switch(uid, key, payload)
-            elif domain == "button": self._handle_button(uid, key)
-            elif domain == "number": self._handle_number(uid, key, payload)
-            elif domain == "select": self._handle_select(uid, key, payload)
-            elif domain == "text": self._handle_text(uid, key, payload) # 👇 修正：新增 text 路由
+            uid, domain, key = self._parse_topic(topic)
+            if uid is None: return
+            # 📦 批次交易：{base_topic}/{uid}/transaction，payload 為 {"key": 值, ...}
+            if domain == "transaction": return (yield from self.run_transaction(uid, payload))
+
+            state = self._admit(uid)
+            if state == "offline": return self._reject(uid, [key])
+            if domain == "button" and self._is_time_sync(key):
+                if state == "probing": return (yield from self._probe(uid, key, self._sync_time, uid))
+                return (yield flow.call(self._sync_time, uid))
+            write = self._build_write(uid, domain, key, payload)
+            if write:
+                if state == "probing": yield from self._probe(uid, key, *write)
+                else: yield from self._write_and_verify(uid, *write)
+            elif write == _NOOP: self.ha_mgr.replay_state(uid)  # 直接以現值回覆 HA
 
         except Exception as e:
             logger.error(f"指令處理錯誤: {e}")
 
+    @staticmethod
+    def _parse_topic(topic: str):
+        """回傳 (uid, domain, key)；交易 topic 的 domain 為 "transaction"，無法解析回傳 (None, None, None)"""
+        parts = topic.split('/')
+        try:
+            if len(parts) < 4: raise ValueError
+            if parts[-1] == "transaction": return int(parts[-2]), "transaction", None
+            return int(parts[-3].split('_')[-1]), parts[-4], parts[-2]
+        except ValueError: return None, None, None
+
+    def _admit(self, uid) -> str:
+        return self.health(uid) if self.health else "online"
+
+    def _reject(self, uid, keys: list):
+        """隔離中的設備：不花任何總線時間，直接回報失敗並把 HA 介面還原成現值"""
+        logger.warning(f"🚫 設備 #{uid} 隔離中，拒絕指令: {', '.join(keys)}")
+        self.ha_mgr.publish_command_result(uid, keys, "rejected", "offline")
+        self.ha_mgr.replay_state(uid)
+
+    def _probe(self, uid, key, write_func, *args) -> bool:
+        """探測中的設備：只送一次、短逾時，不重送"""
+        self.protocol.stream.timeout_cap = self.probe_timeout
+        try: ok = yield flow.call(write_func, *args)
+        finally: self.protocol.stream.timeout_cap = None
+        if ok:
+            logger.info(f"⚡ 設備 #{uid} 探測寫入成功")
+            self.force_full_refresh.add(uid)
+        else:
+            logger.warning(f"⚠️ 設備 #{uid} 探測寫入無回應，不再重送")
+            self.ha_mgr.publish_command_result(uid, [key], "failed", "no_response")
+        return ok
+
+    def _readback(self, uid):
+        raw_data = yield flow.call(self.protocol.read_b1_data, uid)
+        if raw_data:
+            logger.info("✅ 回讀成功，更新 HA")
+            # 真實 B1：設定影子從此可信
+            self.force_full_refresh.discard(uid)
+            self.live_b1.add(uid)
+            # 使用 self.rmap
+            vals = self.protocol.decode(raw_data, self.rmap.B1_INFO, unit_id=uid)
+            bits = self.protocol.decode(raw_data, self.rmap.B3_STATUS_BITS, is_bits=True)
+            self.ha_mgr.publish_values(uid, vals, force=True)
+            self.ha_mgr.publish_bits(uid, bits, force=True)
+        else:
+            logger.warning("⚠️ 回讀失敗")
+            self.force_full_refresh.add(uid)
+
     def _write_and_verify(self, uid, write_func, *args):
-        time.sleep(0.3)
-        if write_func(*args):
+        yield flow.sleep(0.3)
+        if (yield flow.call(write_func, *args)):
             logger.info("⚡ 寫入成功，準備回讀狀態...")
-            time.sleep(0.5) 
-            raw_data = self.protocol.read_b1_data(uid)
-            if raw_data:
-                logger.info("✅ 回讀成功，更新 HA")
-                # 使用 self.rmap
-                vals = self.protocol.decode(raw_data, self.rmap.B1_INFO)
-                bits = self.protocol.decode(raw_data, self.rmap.B3_STATUS_BITS, is_bits=True)
-                self.ha_mgr.publish_state(uid, vals, "state_b1")
-                self.ha_mgr.publish_state(uid, bits, "state_bits")
-            else:
-                logger.warning("⚠️ 回讀失敗")
+            yield flow.sleep(0.5)
+            yield from self._readback(uid)
         else:
             logger.warning("⚠️ 寫入無回應，嘗試重送...")
-            time.sleep(1.0)
-            if write_func(*args): logger.info("✅ 重送成功")
+            yield flow.sleep(1.0)
+            if (yield flow.call(write_func, *args)):
+                logger.info("✅ 重送成功")
+                self.force_full_refresh.add(uid)
             else: logger.error("❌ 寫入最終失敗")
 
-    def _handle_switch(self, uid, key, payload):
+    def run_transaction(self, uid, payload: str):
+        """
+        📦 一次套用多個參數 (例如整組充電曲線)：逐筆背靠背寫入、各自檢查 ACK，全部寫完只回讀一次。
+        payload：{"set_max_charge_curr": 20, "battery_type": "鋰電池", "load_enable": "ON", ...}
+        """
+        plan = self._plan_transaction(uid, payload)
+        if not plan: return
+        state, writes, unchanged, invalid = plan
+
+        yield flow.sleep(0.3)
+        failed = []
+        if state == "probing":
+            # 第一筆當探測：沒回應就整批放棄，不讓死設備佔用總線
+            key, (write_func, *args) = writes[0]
+            if not (yield from self._probe(uid, key, write_func, *args)):
+                return self.ha_mgr.publish_transaction_result(uid, [], [k for k, _ in writes] + invalid)
+            writes, done = writes[1:], [key]
+        else: done = []
+        for key, (write_func, *args) in writes:
+            # 失敗立刻重送一次 (與單筆寫入相同的容錯)，不中斷後續參數
+            if not ((yield flow.call(write_func, *args)) or (yield flow.call(write_func, *args))): failed.append(key)
+        if failed: logger.error(f"❌ 交易中 {len(failed)} 筆寫入失敗: {', '.join(failed)}")
+        else: logger.info(f"⚡ {len(writes)} 筆寫入全部成功，準備回讀狀態...")
+        yield flow.sleep(0.5)
+        yield from self._readback(uid)
+        self.ha_mgr.publish_transaction_result(uid, unchanged + done + [k for k, _ in writes if k not in failed], failed + invalid)
+
+    def _plan_transaction(self, uid, payload: str):
+        """解析交易並建好每筆寫入；回傳 (准入狀態, [(key, write)], 現值相同的 keys, 無法解析的 keys)，不需寫入回傳 None"""
+        try: items = json.loads(payload)
+        except ValueError:
+            logger.error(f"❌ 交易 payload 不是 JSON: {payload}")
+            return None
+        if not isinstance(items, dict) or not items: return None
+        state = self._admit(uid)
+        if state == "offline":
+            self._reject(uid, list(items))
+            self.ha_mgr.publish_transaction_result(uid, [], list(items))
+            return None
+
+        writes, unchanged, invalid = [], [], []
+        for key, value in items.items():
+            if isinstance(value, bool): value = "ON" if value else "OFF"
+            write = self._build_write(uid, self._domain_of(key), key, str(value))
+            if write: writes.append((key, write))
+            elif write == _NOOP: unchanged.append(key)
+            else:
+                # 無法解析的參數算失敗，呼叫端才知道它沒被寫入
+                logger.warning(f"⚠️ 交易略過無法解析的參數 {key}={value}")
+                invalid.append(key)
+        if not writes:
+            self.ha_mgr.publish_transaction_result(uid, unchanged, invalid)
+            return None
+        logger.info(f"📦 設備 #{uid} 批次寫入 {len(writes)} 筆參數")
+        return state, writes, unchanged, invalid
+
+    def _domain_of(self, key):
+        if key in getattr(self.rmap, 'CONTROL_SWITCHES', {}): return "switch"
+        if key in getattr(self.rmap, 'CONTROL_BUTTONS', {}): return "button"
+        target, _ = self._find_d0(key)
+        return target['ha']['type'] if target else None
+
+    def _build_write(self, uid, domain, key, payload):
+        """把一則指令轉成 (寫入函式, 參數...)；無法解析回傳 None"""
+        if domain == "switch": return self._build_switch(uid, key, payload)
+        if domain == "button": return self._build_button(uid, key)
+        if domain == "number": return self._build_number(uid, key, payload)
+        if domain == "select": return self._build_select(uid, key, payload)
+        if domain == "text": return self._build_text(uid, key, payload) # 👇 修正：新增 text 路由
+        return None
+
+    def _is_time_sync(self, key):
+        return self.rmap.CONTROL_BUTTONS.get(key, {}).get('code') == 0xDF
+
+    def _sync_time(self, uid):
+        local_dt = datetime.now(timezone.utc) + timedelta(hours=self.tz_offset)
+        logger.info(f"⏰ 同步時間: {local_dt}")
+        return self.protocol.write_time_sync(uid, local_dt)
+
+    def _build_switch(self, uid, key, payload):
         switch_def = self.rmap.CONTROL_SWITCHES.get(key)
         if switch_def:
             cmd = switch_def['on_code'] if payload.upper() == "ON" else switch_def['off_code']
             logger.info(f"👉 [Switch] 切換 {key} -> {payload}")
-            self._write_and_verify(uid, self.protocol.write_c0_command, uid, cmd)
+            return (self.protocol.write_c0_command, uid, cmd)
 
-    def _handle_button(self, uid, key):
+    def _build_button(self, uid, key):
         btn_def = self.rmap.CONTROL_BUTTONS.get(key)
         if btn_def:
             if btn_def.get('code') == 0xDF:
-                local_dt = datetime.now(timezone.utc) + timedelta(hours=self.tz_offset)
-                logger.info(f"⏰ 同步時間: {local_dt}")
-                self.protocol.write_time_sync(uid, local_dt)
-            else:
-                logger.info(f"👉 [Button] 觸發 {key}")
-                self._write_and_verify(uid, self.protocol.write_c0_command, uid, btn_def['code'])
+                return (self._sync_time, uid)
+            logger.info(f"👉 [Button] 觸發 {key}")
+            return (self.protocol.write_c0_command, uid, btn_def['code'])
 
-    def _handle_number(self, uid, key, payload):
+    def _build_number(self, uid, key, payload):
         target, code = self._find_d0(key)
         if target:
             try:
                 val = float(payload)
+                if self._same_as_shadow(uid, target, val, lambda cur: round(float(cur) / target['scale']) == round(val / target['scale'])):
+                    return _NOOP
                 logger.info(f"👉 [Number] 設定 {key} = {val}")
-                self._write_and_verify(uid, self.protocol.write_d0_command, uid, code, val, target['scale'], target['valid_bytes'])
+                return (self.protocol.write_d0_command, uid, code, val, target['scale'], target['valid_bytes'])
             except: pass
 
-    def _handle_select(self, uid, key, payload):
+    def _build_select(self, uid, key, payload):
         target, code = self._find_d0(key)
         if target:
             ha_conf = target.get('ha', {})
@@ -104,16 +296,37 @@ class CommandHandler:
                     val = options.index(payload)
 
             if val is not None:
+                if self._same_as_shadow(uid, target, payload, lambda cur: cur == payload): return _NOOP
                 logger.info(f"👉 [Select] 設定 {key} = {payload} (ID={val})")
-                self._write_and_verify(uid, self.protocol.write_d0_command, uid, code, val, 1, target['valid_bytes'])
+                return (self.protocol.write_d0_command, uid, code, val, 1, target['valid_bytes'])
 
     # 👇 修正：新增獨立的 text 處理函數 (專門處理 "HH:MM" 字串)
-    def _handle_text(self, uid, key, payload):
+    def _build_text(self, uid, key, payload):
         target, code = self._find_d0(key)
         if target:
+            if self._same_as_shadow(uid, target, payload, lambda cur: self._hhmm(cur) == self._hhmm(payload)): return _NOOP
             logger.info(f"👉 [Text] 設定 {key} = {payload}")
             # payload 已經是 "HH:MM" 字串，直接傳給 protocol 處理 BCD 轉換
-            self._write_and_verify(uid, self.protocol.write_d0_command, uid, code, payload, 1, target['valid_bytes'])
+            return (self.protocol.write_d0_command, uid, code, payload, 1, target['valid_bytes'])
+
+    def _same_as_shadow(self, uid, target, value, matches) -> bool:
+        """
+        🪞 設定影子：與最近一次 B1/B3 解碼 (link_b1 欄位) 的現值比較，相同就不寫。
+        寫入後回讀失敗、或啟動後還沒讀到真實 B1 (狀態來自快照 / 快取) 的設備影子可能過時，一律照寫。
+        """
+        link = target.get('ha', {}).get('link_b1')
+        if not link or uid in self.force_full_refresh or uid not in self.live_b1: return False
+        cur = self.ha_mgr.get_last_state(uid, "state_b1").get(link)
+        if cur is None: return False
+        try: same = matches(cur)
+        except (TypeError, ValueError): return False
+        if same: logger.info(f"⏭️ [{target['key']}] 設備現值已是 {value}，略過寫入")
+        return same
+
+    @staticmethod
+    def _hhmm(text):
+        h, m = map(int, str(text).split(":"))
+        return h, m
 
     def _find_d0(self, key):
         for c, i in self.rmap.D0_PARAMS.items():
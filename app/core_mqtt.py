@@ -1,18 +1,31 @@
 # mqtt連線 
+import asyncio
 import queue
+import threading
 import paho.mqtt.client as mqtt
+from publish_pacer import PublishPacer
 
 class RobustMQTTClient:
-    def __init__(self, broker: str, port: int, username: str = None, password: str = None):
+    def __init__(self, broker: str, port: int, username: str = None, password: str = None,
+                 publish_rate: float = 0, publish_burst: float = 100, max_inflight: int = 20):
         self.broker = broker
         self.port = port
         self.msg_queue = queue.Queue()
+        # 📣 收到指令即設起，喚醒輪詢迴圈 (睡眠提早結束、進行中的輪詢讓路)
+        self.msg_event = threading.Event()
+        # 🌀 設定後收到的指令改交給 sink(msg) (asyncio 橋接用)，不進 msg_queue
+        self.sink = None
         self.on_connected_callback = None 
+        self._connected_once = False
         self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         if username: self.client.username_pw_set(username, password)
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.max_inflight_messages_set(max(1, int(max_inflight)))
+        # 🚦 所有發佈都經過節流執行緒 (token bucket + QoS1 在途上限)
+        self.pacer = PublishPacer(self.client, publish_rate, publish_burst, max_inflight)
 
     def set_lwt(self, topic: str, payload: str = "offline", retain: bool = True):
         self.client.will_set(topic, payload, qos=1, retain=retain)
@@ -25,21 +38,70 @@ class RobustMQTTClient:
         except Exception as e: print(f"❌ [MQTT] 連線失敗: {e}")
 
     def publish(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
-        try: 
-            self.client.publish(topic, payload, qos=qos, retain=retain)
-        except Exception as e: 
-            print(f"⚠️ [MQTT] Publish 失敗 ({topic}): {e}")
+        """排進節流佇列後立即返回 (送出順序不變)"""
+        self.pacer.submit(topic, payload, qos=qos, retain=retain)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待佇列送完、QoS1 都收到 ack (關機前呼叫)"""
+        return self.pacer.flush(timeout)
+
+    def publish_stats(self) -> dict:
+        return self.pacer.stats()
 
     def subscribe(self, topic: str):
         self.client.subscribe(topic)
 
+    def add_handler(self, topic: str, callback):
+        """訂閱 topic 並把符合的訊息直接交給 callback(topic, payload, retain)，不進指令佇列"""
+        self.client.message_callback_add(topic, lambda c, u, msg: callback(msg.topic, msg.payload, msg.retain))
+        self.client.subscribe(topic)
+
+    def remove_handler(self, topic: str):
+        self.client.unsubscribe(topic)
+        self.client.message_callback_remove(topic)
+
     def _on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
-            if self.on_connected_callback: self.on_connected_callback()
+            # 第一次連線 False；之後的斷線重連 True (callback 依此決定要不要重送 discovery)
+            reconnect, self._connected_once = self._connected_once, True
+            self.pacer.set_connected(True)
+            if self.on_connected_callback: self.on_connected_callback(reconnect)
         else: print(f"❌ [MQTT] 連線拒絕: {rc}")
 
+    def _on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        self.pacer.on_publish(mid)
+
     def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties=None):
+        # 斷線期間訊息留在節流佇列 (同 topic 合併)，重連後再送
+        self.pacer.set_connected(False)
         if reason_code != 0: print(f"⚠️ [MQTT] 斷線 ({reason_code})")
         
     def _on_message(self, client, userdata, msg):
+        if self.sink: return self.sink(msg)
         self.msg_queue.put(msg)
+        self.msg_event.set()
+
+class AsyncMQTTBridge:
+    """
+    🌀 paho 網路執行緒 → asyncio 事件迴圈
+    🔥 收到的指令以 call_soon_threadsafe 放進 asyncio.Queue，事件迴圈直接 await，不再靠 threading.Event 喚醒。
+    🔥 發佈不需要橋接：RobustMQTTClient.publish() 只是排進節流佇列，本來就不會阻塞事件迴圈。
+    """
+    def __init__(self, mqtt: RobustMQTTClient, loop: asyncio.AbstractEventLoop):
+        self.mqtt = mqtt
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        mqtt.sink = self._from_paho
+        # 橋接前已進 msg_queue 的指令照順序接上
+        while not mqtt.msg_queue.empty(): self.queue.put_nowait(mqtt.msg_queue.get())
+
+    def _from_paho(self, msg):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, msg)
+
+    async def get(self, timeout: float = None):
+        """取下一則指令；timeout 內沒有回傳 None"""
+        try: return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError: return None
+
+    def close(self):
+        self.mqtt.sink = None
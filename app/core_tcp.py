@@ -1,29 +1,95 @@
+import select
 import socket
 import time
 import logging
 
 logger = logging.getLogger("TCP")
 
-class RobustTCPClient:
-    def __init__(self, host: str, port: int, timeout: float = 3.0):
+class RttEstimator:
+    """
+    📶 Jacobson/Karels RTT 估算 (同 TCP RTO)
+    srtt ← 7/8·srtt + 1/8·r，rttvar ← 3/4·rttvar + 1/4·|srtt − r|，rto = srtt + 4·rttvar
+    逾時時 rto 加倍 (最多 4 倍)，下一次成功即恢復；設定的 timeout 只當上限。
+    """
+    MAX_BACKOFF = 4
+
+    def __init__(self, floor: float, ceiling: float):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 1
+
+    def timed_out(self):
+        if self.srtt is not None: self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+
+    @property
+    def rto(self) -> float:
+        if self.srtt is None: return self.ceiling
+        return min(max((self.srtt + 4 * self.rttvar) * self.backoff, self.floor), self.ceiling)
+
+class AdaptiveTimeouts:
+    """每台設備 × 每種回應長度一組 RTT 估算；min_timeout=None 代表關閉自適應，固定用 timeout (同步 / asyncio 傳輸共用)"""
+    def __init__(self, timeout: float = 3.0, min_timeout: float = None):
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self._rtt = {}
+
+    def timeout_for(self, unit_id: int, length: int) -> float:
+        if self.min_timeout is None: return self.timeout
+        est = self._rtt.get((unit_id, length))
+        return est.rto if est else self.timeout
+
+    def record_rtt(self, unit_id: int, length: int, rtt: float = None):
+        """rtt=None 代表這次逾時"""
+        if self.min_timeout is None: return
+        est = self._rtt.get((unit_id, length))
+        if est is None:
+            est = self._rtt[(unit_id, length)] = RttEstimator(self.min_timeout, self.timeout)
+        if rtt is None: est.timed_out()
+        else: est.sample(rtt)
+
+    def rtt_stats(self) -> dict:
+        return {key: (round(est.srtt or 0, 3), round(est.rto, 3)) for key, est in self._rtt.items()}
+
+class RobustTCPClient(AdaptiveTimeouts):
+    def __init__(self, host: str, port: int, timeout: float = 3.0, min_timeout: float = None):
+        super().__init__(timeout, min_timeout)
         self.host = host
         self.port = port
-        self.timeout = timeout
         self._sock = None
+        self._rx_views = {}
+        self._scratch = bytearray(4096)
+        self._poller = None
 
     def connect(self) -> bool:
         try:
             self.close() 
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self._sock.settimeout(self.timeout)
-            self._sock.connect((self.host, self.port))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(self.timeout)
+            sock.connect((self.host, self.port))
+            self._attach(sock)
             time.sleep(0.1) 
             return True
         except Exception:
             self._sock = None
             return False
 
+    def _attach(self, sock):
+        self._sock = sock
+        self._sock.settimeout(self.timeout)
+        self._poller = select.poll()
+        self._poller.register(sock, select.POLLIN)
+
     def close(self):
         if self._sock:
             try:
@@ -31,51 +97,58 @@ class RobustTCPClient:
                 self._sock.close()
             except: pass
         self._sock = None
+        self._poller = None
 
-    def flush_buffer(self):
-        """🔥 優化：強制清空緩衝區，防止讀到舊資料"""
-        if not self._sock: return
+    def discard_pending(self) -> int:
+        """非阻塞丟棄 socket 內已到達的殘留資料 (不等待)，回傳丟棄的 bytes 數"""
+        if not self._sock: return 0
+        dropped = 0
         try:
-            self._sock.settimeout(0.05)
-            while True:
-                chunk = self._sock.recv(4096)
-                if not chunk: break
-        except socket.timeout: pass
+            # 用 poll(0) 判斷有無資料，避免非阻塞 recv 每次丟 BlockingIOError
+            while self._poller.poll(0):
+                n = self._sock.recv_into(self._scratch)
+                if not n:
+                    self.close(); break
+                dropped += n
         except Exception: self.close()
+        return dropped
+
+    def rx_buffer(self, length: int) -> memoryview:
+        """每種封包長度一塊預先配置的接收緩衝 (93 / 37 / 8 bytes)，重複使用不再配置"""
+        view = self._rx_views.get(length)
+        if view is None:
+            view = memoryview(bytearray(length))
+            self._rx_views[length] = view
+        return view
+
+    def recv_into_until(self, view: memoryview, filled: int, deadline: float) -> int:
+        """把 view[filled:] 收滿或到 deadline (monotonic) 為止；回傳已填 bytes 數，斷線回傳 -1"""
+        if not self._sock: return -1
+        length = len(view)
+        try:
+            while filled < length:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                self._sock.settimeout(remaining)
+                n = self._sock.recv_into(view[filled:] if filled else view)
+                if not n:
+                    self.close(); return -1
+                filled += n
+        except socket.timeout: pass
+        except Exception as e:
+            logger.error(f"接收錯誤: {e}")
+            self.close()
+            return -1
         finally:
             if self._sock: self._sock.settimeout(self.timeout)
+        return filled
 
     def send(self, data: bytes) -> bool:
         if not self._sock:
             if not self.connect(): return False
         try:
-            self.flush_buffer()
             self._sock.sendall(data)
             return True
         except Exception:
             self.close()
             return False
-
-    def recv_fixed(self, length: int) -> bytes:
-        if not self._sock: return None
-        data = b''
-        start_time = time.time()
-        try:
-            while len(data) < length:
-                if (time.time() - start_time) > self.timeout:
-                    if len(data) > 0:
-                        logger.warning(f"⚠️ 接收超時，僅收到 {len(data)}/{length} bytes")
-                    return None
-                
-                needed = length - len(data)
-                chunk = self._sock.recv(needed)
-                
-                if not chunk:
-                    self.close(); return None
-                data += chunk
-            return data
-        except socket.timeout: return None
-        except Exception as e:
-            logger.error(f"接收錯誤: {e}")
-            self.close()
-            return None
@@ -0,0 +1,72 @@
+# asyncio 版 TCP 傳輸
+import asyncio
+import logging
+
+from core_tcp import AdaptiveTimeouts
+
+logger = logging.getLogger("TCP")
+
+class AsyncTCPClient(AdaptiveTimeouts):
+    """
+    🌀 asyncio streams 傳輸：open_connection 建線，所有等待都以 wait_for 設期限，等回應時不佔住執行緒
+    🔥 一個事件迴圈就能同時跑多個網關的總線；自適應逾時 (RTT 估算) 與同步版共用。
+    🔥 斷線後下一次 send 自動重連；逾時時已收到的半截封包留在 StreamReader，下一次請求前丟棄。
+    """
+    def __init__(self, host: str, port: int, timeout: float = 3.0, min_timeout: float = None):
+        super().__init__(timeout, min_timeout)
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def connect(self) -> bool:
+        self.close()
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self._reader = self._writer = None
+            return False
+        await asyncio.sleep(0.1)
+        return True
+
+    def close(self):
+        if self._writer:
+            try: self._writer.close()
+            except Exception: pass
+        self._reader = self._writer = None
+
+    async def discard_pending(self) -> int:
+        """丟棄 StreamReader 內已到達的殘留資料 (不等待)，回傳丟棄的 bytes 數"""
+        if not self._reader: return 0
+        dropped = 0
+        try:
+            while True:
+                # timeout(0)：緩衝有資料時 read 不會讓出，直接回傳；沒資料時立刻逾時
+                async with asyncio.timeout(0): chunk = await self._reader.read(4096)
+                if not chunk:
+                    self.close(); break
+                dropped += len(chunk)
+        except TimeoutError: pass
+        except OSError: self.close()
+        return dropped
+
+    async def send(self, data: bytes) -> bool:
+        if not self._writer:
+            if not await self.connect(): return False
+        try:
+            self._writer.write(data)
+            await asyncio.wait_for(self._writer.drain(), self.timeout)
+            return True
+        except (OSError, asyncio.TimeoutError):
+            self.close()
+            return False
+
+    async def read_exactly(self, length: int):
+        """收滿 length bytes (期限由呼叫端以 wait_for 控制，取消時已到的資料留在緩衝)；斷線回傳 None"""
+        if not self._reader: return None
+        try: return await self._reader.readexactly(length)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logger.error(f"接收錯誤: {e!r}")
+            self.close()
+            return None
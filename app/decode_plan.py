@@ -0,0 +1,118 @@
+# 預編譯解碼計畫：地圖只在啟動時解析一次
+import struct
+
+_CODES = {(1, False): "B", (1, True): "b", (2, False): "H", (2, True): "h", (4, False): "I", (4, True): "i"}
+
+# 轉換種類
+_RAW, _SCALED, _ENUM_TABLE, _ENUM_DICT, _BCD = range(5)
+
+class DecodePlan:
+    """
+    🧮 暫存器地圖 (B1_INFO / B3_REALTIME) 的預編譯解碼計畫
+    🔥 欄位依位址切成區段，每段一個 struct.Struct (空隙用 pad byte)，一次 unpack_from。
+    🔥 縮放除數、enum 對照表 (1 byte 欄位展開成 256 格 tuple) 都在編譯時算好，解碼時不再查 item.get()。
+    🔥 設定區段 (沒有 state_class 的欄位，例如 B1 的 8~29、52~83 與時控 BCD) 可記憶：
+       原始 bytes 與上一幀相同就直接沿用上次的解碼結果。
+    """
+    def __init__(self, map_list, frame_len: int = None):
+        self.keys = [item['key'] for item in map_list]
+        fields = []
+        for item in map_list:
+            off, ln = item['offset'], item['length']
+            if ln <= 0: continue  # 衍生欄位 (charge_power)
+            if frame_len is not None and off + ln > frame_len: continue
+            if item.get('bcd_time') and ln == 4: code = "4B"
+            elif (ln, bool(item.get('signed'))) in _CODES: code = _CODES[(ln, bool(item.get('signed')))]
+            else: continue
+            static = not (item.get('ha') or {}).get('state_class')
+            fields.append((off, ln, code, static, item))
+        fields.sort(key=lambda f: f[0])
+
+        # 連續且同類 (設定/即時) 的欄位併成一段；重疊的欄位另起一段
+        runs = []
+        for f in fields:
+            if runs and runs[-1][-1][3] == f[3] and f[0] >= runs[-1][-1][0] + runs[-1][-1][1]:
+                runs[-1].append(f)
+            else: runs.append([f])
+
+        self.sections = []  # (start, end, Struct, convs, static)
+        for run in runs:
+            start = run[0][0]
+            fmt, pos, idx, convs = ">", start, 0, []
+            for off, ln, code, static, item in run:
+                if off > pos: fmt += f"{off - pos}x"
+                fmt += code
+                convs.append(self._converter(item, idx))
+                idx += 4 if code == "4B" else 1
+                pos = off + ln
+            self.sections.append((start, pos, struct.Struct(fmt), tuple(convs), run[0][3]))
+        self.size = max((end for _, end, _, _, _ in self.sections), default=0)
+        self.derive_power = "battery_voltage" in self.keys and "charge_current" in self.keys
+
+    @staticmethod
+    def _converter(item, idx):
+        key, sc, ln = item['key'], item['scale'], item['length']
+        if item.get('bcd_time') and ln == 4: return (key, _BCD, idx, None, None)
+        enum = item.get('map')
+        if enum and ln == 1:
+            signed = bool(item.get('signed'))
+            table = tuple(enum.get(v - 256 if signed and v > 127 else v) for v in range(256))
+            return (key, _ENUM_TABLE, idx, sc, table)
+        if enum: return (key, _ENUM_DICT, idx, sc, enum)
+        return (key, _SCALED if sc != 1 else _RAW, idx, sc, None)
+
+    @staticmethod
+    def _convert(vals, convs, result):
+        for key, kind, idx, sc, lut in convs:
+            v = vals[idx]
+            if kind == _RAW: result[key] = v
+            elif kind == _SCALED: result[key] = round(v / sc, 2)
+            elif kind == _BCD:
+                result[key] = f"{vals[idx] * 10 + vals[idx + 1]:02d}:{vals[idx + 2] * 10 + vals[idx + 3]:02d}"
+            else:
+                label = lut[v & 0xFF] if kind == _ENUM_TABLE else lut.get(v)
+                if label is not None: result[key] = label
+                else: result[key] = round(v / sc, 2) if sc != 1 else v
+
+    def decode(self, buf, memo: dict = None) -> dict:
+        """memo：同一台設備跨幀共用的記憶 dict；memo['changed'] 回報本幀設定區段是否有變"""
+        result = {}
+        changed = False
+        for i, (start, end, st, convs, static) in enumerate(self.sections):
+            if static and memo is not None:
+                prev = memo.get(i)
+                if prev is not None and buf[start:end] == prev[0]:
+                    result.update(prev[1])
+                    continue
+                part = {}
+                self._convert(st.unpack_from(buf, start), convs, part)
+                memo[i] = (bytes(buf[start:end]), part)
+                result.update(part)
+                changed = True
+            else:
+                self._convert(st.unpack_from(buf, start), convs, result)
+        if memo is not None: memo['changed'] = changed
+        if self.derive_power and "battery_voltage" in result and "charge_current" in result:
+            result["charge_power"] = round(result["battery_voltage"] * result["charge_current"], 1)
+        return result
+
+class BitPlan:
+    """
+    🧮 狀態位元地圖的預編譯解碼計畫
+    🔥 每個狀態 byte 一張 256 格展開表，表格內是預先建好的 {key: "ON"/"OFF"}，解碼只剩 dict.update。
+    """
+    def __init__(self, bits_map: dict):
+        by_byte = {}
+        for key, info in bits_map.items():
+            by_byte.setdefault(info['byte'], []).append((key, info['bit']))
+        self.tables = tuple(
+            (byte_idx, tuple({key: "ON" if (v >> bit) & 0x01 else "OFF" for key, bit in bits} for v in range(256)))
+            for byte_idx, bits in sorted(by_byte.items())
+        )
+
+    def decode(self, buf) -> dict:
+        result = {}
+        n = len(buf)
+        for byte_idx, table in self.tables:
+            if byte_idx < n: result.update(table[buf[byte_idx]])
+        return result
@@ -0,0 +1,95 @@
+# 設備健康狀態：指數退避 + 半開探測
+import logging
+import random
+import time
+
+logger = logging.getLogger("Health")
+
+class DeviceHealth:
+    """
+    🩺 每台設備的故障隔離狀態 (取代 main 裡的 offline_devices / device_fail_counts)
+    🔥 全部用 monotonic 時間，NTP 校時不會讓隔離期跳動。
+    🔥 隔離時間 = base_delay × 2^(失敗次數-1)，加上 ±jitter 的隨機抖動 (多台同時掛掉不會同步重試)，上限 max_delay；
+       連續失敗達 long_delay_threshold 次直接用上限。
+    🔥 隔離期滿進入半開 (probing)：只給一次 probe_timeout 的短逾時嘗試，死位址每次探測只花極短的總線時間。
+       每連續失敗 4 次穿插一次完整逾時的探測，回應較慢的設備 (或慢速網關) 仍能在背景被找到。
+    """
+    def __init__(self, base_delay: float, max_delay: float, fail_threshold: int, long_delay_threshold: int,
+                 probe_timeout: float = 0.5, jitter: float = 0.2, clock=time.monotonic, rng=random.random):
+        self.base_delay = float(base_delay)
+        self.max_delay = max(float(max_delay), self.base_delay)
+        self.fail_threshold = fail_threshold
+        self.long_delay_threshold = long_delay_threshold
+        self.probe_timeout = probe_timeout
+        self.jitter = jitter
+        self.clock = clock
+        self.rng = rng
+        self._fails = {}   # uid -> 連續失敗次數
+        self._until = {}   # uid -> 隔離結束時間 (monotonic)；不在表內 = 正常
+        self._offline = set()  # 已在 HA 標為離線的設備 (達門檻那次只通報一次)
+
+    def add_unknown(self, uid):
+        """啟動時還沒讀到過的設備：直接進入半開，第一次輪詢就用短逾時探測"""
+        self._until[uid] = self.clock()
+
+    def state(self, uid, now: float = None) -> str:
+        """online / offline (隔離中) / probing (隔離期滿，等待探測結果)"""
+        until = self._until.get(uid)
+        if until is None: return "online"
+        now = self.clock() if now is None else now
+        return "offline" if now < until else "probing"
+
+    def fails(self, uid) -> int:
+        return self._fails.get(uid, 0)
+
+    def timeout_cap(self, uid):
+        """探測中的設備回傳短逾時，其餘回傳 None (照自適應逾時)"""
+        if self.state(uid) != "probing" or self._fails.get(uid, 0) % 4 == 3: return None
+        return self.probe_timeout
+
+    def success(self, uid) -> bool:
+        """讀取成功；回傳是否為「失敗後恢復」"""
+        self._until.pop(uid, None)
+        self._offline.discard(uid)
+        return self._fails.pop(uid, 0) > 0
+
+    def failure(self, uid):
+        """讀取失敗；回傳 (隔離秒數, 是否剛達到 HA 離線門檻)"""
+        n = self._fails.get(uid, 0) + 1
+        self._fails[uid] = n
+        if n >= self.long_delay_threshold:
+            delay = self.max_delay
+            if n == self.long_delay_threshold:
+                logger.error(f"❌ 設備 #{uid} 連續失敗達 {n} 次！進入【懲罰性隔離】{self.max_delay:.0f} 秒。")
+        else:
+            delay = min(self.max_delay, self.base_delay * (2 ** (n - 1)))
+        delay *= 1 + self.jitter * (2 * self.rng() - 1)
+        self._until[uid] = self.clock() + delay
+        logger.debug(f"設備 #{uid} 第 {n} 次失敗，隔離 {delay:.1f} 秒")
+        # 用 >= 而非 ==：重啟前就已超過門檻的設備也會被標為離線
+        went_offline = n >= self.fail_threshold and uid not in self._offline
+        if went_offline: self._offline.add(uid)
+        return delay, went_offline
+
+    def export(self) -> dict:
+        """持久化用：{uid: (連續失敗次數, 剩餘隔離秒數)}"""
+        now = self.clock()
+        return {uid: (self._fails.get(uid, 0), max(0.0, until - now)) for uid, until in self._until.items()}
+
+    def restore(self, uid, fails: int, retry_in: float) -> bool:
+        """從快取還原：已知失敗的設備重啟後沿用原本的退避進度；回傳是否已達 HA 離線門檻 (呼叫端負責通報)"""
+        if fails <= 0: return False
+        self._fails[uid] = fails
+        self._until[uid] = self.clock() + retry_in
+        if fails < self.fail_threshold: return False
+        self._offline.add(uid)
+        return True
+
+    def isolated_count(self) -> int:
+        return len(self._until)
+
+    def stats(self) -> dict:
+        now = self.clock()
+        return {uid: {"state": self.state(uid, now), "fails": self._fails.get(uid, 0),
+                      "retry_in": round(max(0.0, until - now), 1)}
+                for uid, until in self._until.items()}
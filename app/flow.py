@@ -0,0 +1,54 @@
+# 流程驅動：同一份輪詢 / 指令決策 (generator)，由執行緒版或 asyncio 版執行 I/O
+import asyncio
+import inspect
+import time
+
+# 🔀 流程 (flow) 是只做決策的 generator：要碰 I/O 時 yield 一個動作，由驅動器執行後把結果送回。
+# 🔥 執行緒版 run() 直接阻塞執行；asyncio 版 run_async() 改成 await，決策邏輯只寫一份。
+# 🔥 動作丟出的例外會原樣拋回流程裡 (就像直接呼叫一樣可以 try/except)。
+
+def call(func, *args):
+    """呼叫 func(*args)；asyncio 版若回傳 coroutine 會 await"""
+    return ("call", func, args)
+
+def sleep(seconds: float):
+    return ("sleep", seconds)
+
+def wait(event, timeout: float):
+    """等 event 被設起或逾時 (threading.Event / asyncio.Event)"""
+    return ("wait", event, timeout)
+
+def blocking(func, *args):
+    """阻塞的檔案 I/O (寫快取 + fsync)：asyncio 版丟到執行緒，不卡住事件迴圈"""
+    return ("blocking", func, args)
+
+def run(flow):
+    """🧵 執行緒版：每個動作直接阻塞執行；回傳流程的 return 值"""
+    result = error = None
+    while True:
+        try: op = flow.throw(error) if error else flow.send(result)
+        except StopIteration as e: return e.value
+        result = error = None
+        try:
+            if op[0] == "sleep": time.sleep(op[1])
+            elif op[0] == "wait": result = op[1].wait(op[2])
+            else: result = op[1](*op[2])
+        except Exception as e: error = e
+
+async def run_async(flow):
+    """🌀 asyncio 版：等待都改成 await，檔案 I/O 交給 asyncio.to_thread"""
+    result = error = None
+    while True:
+        try: op = flow.throw(error) if error else flow.send(result)
+        except StopIteration as e: return e.value
+        result = error = None
+        try:
+            if op[0] == "sleep": await asyncio.sleep(op[1])
+            elif op[0] == "wait":
+                try: result = await asyncio.wait_for(op[1].wait(), op[2])
+                except asyncio.TimeoutError: result = False
+            elif op[0] == "blocking": result = await asyncio.to_thread(op[1], *op[2])
+            else:
+                result = op[1](*op[2])
+                if inspect.isawaitable(result): result = await result
+        except Exception as e: error = e
@@ -0,0 +1,144 @@
+# 串流分幀器：取代每次發送前阻塞清空緩衝
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("Frame")
+
+class FrameStream:
+    """
+    🧩 Ampinvt 回應分幀器
+    🔥 直接收進 transport 預先配置的固定長度緩衝 (recv_into + memoryview)，整個接收路徑零拷貝。
+    🔥 以 [unit_id, cmd] 表頭 + checksum 重新對齊：錯位時把候選表頭之後的半截封包搬到緩衝開頭繼續收。
+    🔥 錯位雜訊、其他設備的舊封包直接丟棄；發送前只做「非阻塞」清空，不再每次白等 50 ms。
+    🔥 可插隊：preempt (threading.Event) 被設起時，等待中的輪詢最多再給 preempt_budget 秒 (約一個封包時間)，
+       逾時回傳 None 並設 preempted=True (不算設備失敗、不影響 RTT 估計)，讓 HA 指令立即上總線。
+    """
+    SLICE = 0.05  # 可插隊時每段等待的長度
+
+    def __init__(self, transport, debug: bool = False, preempt_budget: float = 0.2):
+        self.transport = transport
+        self.debug = debug
+        self.dropped_bytes = 0
+        self.preempt = None
+        self.preempt_budget = preempt_budget
+        self.preempted = False
+        self.timeout_cap = None  # 探測中的設備：單次等待上限 (秒)
+
+    @staticmethod
+    def _checksum_ok(view) -> bool:
+        return ((sum(view) - view[-1]) & 0xFF) == view[-1]
+
+    @staticmethod
+    def _resync_offset(view, unit_id: int, cmds) -> int:
+        """找下一個可能的表頭位置 (第 0 byte 已確定不是合法封包開頭)"""
+        length = len(view)
+        for j in range(1, length):
+            if view[j] == unit_id and (j + 1 == length or view[j + 1] in cmds): return j
+        return length
+
+    def _begin(self) -> bool:
+        """發送前：插隊旗標已設起就不送 (preempted=True)"""
+        self.preempted = self.preempt is not None and self.preempt.is_set()
+        return not self.preempted
+
+    def _discarded(self, stale: int):
+        if not stale: return
+        self.dropped_bytes += stale
+        if self.debug: logger.debug(f"🗑️ 丟棄 {stale} bytes 殘留資料")
+
+    def _timeout(self, unit_id: int, length: int, timeout: float = None) -> float:
+        if timeout is None: timeout = self.transport.timeout_for(unit_id, length)
+        if self.timeout_cap is not None: timeout = min(timeout, self.timeout_cap)
+        return timeout
+
+    def _give_way(self, unit_id: int, filled: int, length: int):
+        """插隊期限到了還沒收完：讓路給指令，不算設備失敗、不記 RTT"""
+        if self.debug: logger.debug(f"⏩ 設備 #{unit_id} 輪詢讓路給指令 (已收 {filled}/{length} bytes)")
+        self.preempted = True
+
+    def _timed_out(self, unit_id: int, filled: int, length: int, timeout: float):
+        if filled > 0: logger.warning(f"⚠️ 接收超時 ({timeout:.2f}s)，僅收到 {filled}/{length} bytes")
+        self.transport.record_rtt(unit_id, length, None)
+
+    def _accept(self, frame, unit_id: int, cmds, length: int, rtt: float) -> int:
+        """收滿 length 的候選封包：表頭 + checksum 正確回傳 0 並記錄 RTT；否則回傳重新對齊要丟棄的 bytes 數"""
+        if frame[0] == unit_id and frame[1] in cmds and self._checksum_ok(frame):
+            self.transport.record_rtt(unit_id, length, rtt)
+            return 0
+        skip = self._resync_offset(frame, unit_id, cmds)
+        if self.debug: logger.debug(f"🗑️ 重新對齊，丟棄 {skip} bytes: {bytes(frame[:skip]).hex(' ')}")
+        self.dropped_bytes += skip
+        return skip
+
+    def request(self, req: bytes, unit_id: int, cmds, length: int, timeout: float = None):
+        """送出請求並等待 [unit_id, cmd] 開頭、長度 length、checksum 正確的回應 (回傳 memoryview)"""
+        preempt = self.preempt
+        if not self._begin(): return None
+        self._discarded(self.transport.discard_pending())
+        if not self.transport.send(req): return None
+
+        timeout = self._timeout(unit_id, length, timeout)
+        sent_at = time.monotonic()
+        deadline = sent_at + timeout
+        view = self.transport.rx_buffer(length)
+        filled = 0
+        cut = False
+        while True:
+            until = deadline
+            if preempt is not None and not cut:
+                if preempt.is_set():
+                    cut = True
+                    deadline = min(deadline, time.monotonic() + self.preempt_budget)
+                    until = deadline
+                else: until = min(deadline, time.monotonic() + self.SLICE)
+            filled = self.transport.recv_into_until(view, filled, until)
+            if filled < 0: return None
+            if filled < length and time.monotonic() < deadline: continue
+            if filled < length:
+                if cut: self._give_way(unit_id, filled, length)
+                else: self._timed_out(unit_id, filled, length, timeout)
+                return None
+            skip = self._accept(view, unit_id, cmds, length, time.monotonic() - sent_at)
+            if not skip: return view
+            filled = length - skip
+            if filled: view[:filled] = view[skip:]
+
+class AsyncFrameStream(FrameStream):
+    """
+    🌀 asyncio 版分幀器 (搭配 AsyncTCPClient)：同樣的表頭 / checksum 重新對齊，等待改用 wait_for 期限
+    🔥 preempt 為 asyncio.Event：等回應時同時等指令，一被設起就把期限縮成 preempt_budget，不再切成 50 ms 小段輪詢。
+    """
+    async def request(self, req: bytes, unit_id: int, cmds, length: int, timeout: float = None):
+        """送出請求並等待 [unit_id, cmd] 開頭、長度 length、checksum 正確的回應 (回傳 bytes)"""
+        preempt = self.preempt
+        if not self._begin(): return None
+        self._discarded(await self.transport.discard_pending())
+        if not await self.transport.send(req): return None
+
+        timeout = self._timeout(unit_id, length, timeout)
+        loop = asyncio.get_running_loop()
+        sent_at = loop.time()
+        deadline = sent_at + timeout
+        frame, need = b"", length
+        cut = False
+        while True:
+            read = asyncio.ensure_future(self.transport.read_exactly(need))
+            if preempt is not None and not cut:
+                woke = asyncio.ensure_future(preempt.wait())
+                try: await asyncio.wait((read, woke), timeout=max(0.0, deadline - loop.time()),
+                                        return_when=asyncio.FIRST_COMPLETED)
+                finally: woke.cancel()
+                if not read.done() and preempt.is_set():
+                    cut = True
+                    deadline = min(deadline, loop.time() + self.preempt_budget)
+            try: chunk = await asyncio.wait_for(read, max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                if cut: self._give_way(unit_id, len(frame), length)
+                else: self._timed_out(unit_id, len(frame), length, timeout)
+                return None
+            if chunk is None: return None
+            frame += chunk
+            skip = self._accept(frame, unit_id, cmds, length, loop.time() - sent_at)
+            if not skip: return frame
+            frame, need = frame[skip:], skip
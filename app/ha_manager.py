@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
+import threading
 import time
 from core_mqtt import RobustMQTTClient
+from publish_filter import PublishFilter
 import logging
 
 logger = logging.getLogger("HA_MGR")
@@ -14,7 +17,10 @@ class HAManager:
     🔥 修正：修復 _pub_text 的 value_template 狀態追蹤邏輯。
     🔥 升級：全面支援 entity_category，將實體精準分流至「診斷」與「配置」面板。
     """
-    def __init__(self, mqtt: RobustMQTTClient, config: dict, rmap):
+    # 死區設定 key 對應的量測單位
+    DEADBAND_UNITS = {"deadband_voltage": "V", "deadband_current": "A", "deadband_power": "W", "deadband_temperature": "°C"}
+
+    def __init__(self, mqtt: RobustMQTTClient, config: dict, rmap, publish_cfg: dict = None):
         self.mqtt = mqtt
         self.rmap = rmap 
         self.prefix = config['discovery_prefix']
@@ -31,58 +37,248 @@ class HAManager:
             "select": f"{self.prefix}/select",
             "text": f"{self.prefix}/text"
         }
+        # 📦 discovery 模式：entity = 每個實體一則 config (舊版)；device = 每台控制器一則 config
+        self.discovery_mode = config.get('discovery_mode', 'entity')
+        if self.discovery_mode not in ("entity", "device"): self.discovery_mode = "entity"
+        self.migrate_discovery = bool(config.get('migrate_discovery', False))
+        self._collect = None
+        self._collect_lock = threading.Lock()  # 多個網關 worker 可能同時送 discovery
+        # 共用的 discovered / device_details 由多個網關 worker 寫入，其他執行緒要在鎖內取複本
+        self.devices_lock = threading.Lock()
+        self._discovery_cache = {}   # uid -> ((uid, details), [(topic, payload 字串, sha1)])
+        self._retained = {}          # broker 上本機 retained config 的 sha1 {topic: digest}
+        self._availability = {}      # uid -> 最後一次發佈的設備可用性；discovery / birth 重送沿用，不把離線設備洗成 online
+        self._last_retained_at = 0.0
+        # 🛰️ retained 讀回完成前上線的設備先排隊，讀回後一起比對送出
+        self._synced = threading.Event()
+        self._announce_lock = threading.Lock()
+        self._announce_pending = {}  # uid -> device_details
+        # 🐣 HA birth message：HA 自己重啟後 (status = online) 才重送 discovery 與最後狀態
+        self.ha_status_topic = config.get('ha_status_topic') or f"{self.prefix}/status"
+        self.birth_replay_window = float(config.get('birth_replay_window', 10) or 0)
+        self._replay_thread = None
+
+        # 🧵 state topic 配置：combined = 全部塞 state_b1 / state_bits (舊版)；
+        #    split = 即時 (state_rt) / 設定診斷 (state_cfg) / 狀態位元 (state_bits) 分開；
+        #    raw = 每個欄位一個 topic、純值、不需要模板
+        self.state_mode = config.get('state_topic_mode', 'combined')
+        if self.state_mode not in ("combined", "split", "raw"): self.state_mode = "combined"
+        self._field_group = {}
+        for item in rmap.B1_INFO:
+            self._field_group[item['key']] = "state_rt" if (item.get('ha') or {}).get('state_class') else "state_cfg"
+
+        # 最後一次解碼出的狀態 {(uid, sub_topic): dict}，B3 快速路徑要疊在完整 B1 資料上
+        self.last_state = {}
+
+        # 📉 Delta 發佈：依欄位單位套用死區，定期完整刷新
+        # 🔥 只有即時量測欄位 (state_class=measurement) 套死區；浮充電壓等設定值一變就發佈
+        publish_cfg = publish_cfg or {}
+        unit_band = {unit: float(publish_cfg.get(opt, 0) or 0) for opt, unit in self.DEADBAND_UNITS.items()}
+        deadbands = {}
+        for item in list(rmap.B1_INFO) + list(getattr(rmap, 'B3_REALTIME', [])):
+            if (item.get('ha') or {}).get('state_class') != "measurement": continue
+            if unit_band.get(item.get('unit')): deadbands[item['key']] = unit_band[item['unit']]
+        full_refresh = float(publish_cfg.get('full_refresh_interval', 300) or 0)
+        self.publish_filter = PublishFilter(deadbands, full_refresh)
+        # expire_after：0 = 自動 (完整刷新週期的兩倍)，負數 = 不設定
+        expire = int(publish_cfg.get('expire_after', 0) or 0)
+        self.expire_after = expire if expire > 0 else (int(full_refresh * 2) if expire == 0 and full_refresh else 0)
 
     def _dumps(self, payload: dict) -> str:
         return json.dumps(payload, ensure_ascii=False)
 
-    def send_discovery(self, unit_ids: list, device_details: dict = {}):
-        logger.info(f"📤 發送 HA Discovery (V8.3 版面淨化版) 預計生成設備: {unit_ids}")
+    def sync_discovery(self, unit_ids: list, device_details: dict, quiet: float = 1.0, max_wait: float = 5.0):
+        """
+        🔁 連線後先讀回 broker 上的 retained config，只補送缺少或內容不同的部分。
+        在背景執行緒等待 retained 訊息 (paho 的 callback 執行緒不能被卡住)。
+        """
+        self._synced.clear()
+        filters = [f"{self.prefix}/+/+/+/config", f"{self.prefix}/device/+/config"]
+        self._retained = {}  # 重新連線時 broker 可能已遺失 retained，以這次讀回的為準
+        self._last_retained_at = time.monotonic()
+        for f in filters: self.mqtt.add_handler(f, self._on_retained_config)
+
+        def _wait_and_send():
+            deadline = time.monotonic() + max_wait
+            while time.monotonic() < deadline and time.monotonic() - self._last_retained_at < quiet:
+                time.sleep(0.1)
+            for f in filters: self.mqtt.remove_handler(f)
+            logger.info(f"🔁 讀回 {len(self._retained)} 則本機 retained discovery")
+            with self._announce_lock:
+                pending, self._announce_pending = self._announce_pending, {}
+                self._synced.set()
+            with self.devices_lock: details = dict(device_details)
+            details.update(pending)
+            ids = list(unit_ids) + [uid for uid in pending if uid not in unit_ids]
+            if ids: self.send_discovery(ids, details)
+
+        threading.Thread(target=_wait_and_send, name="discovery-sync", daemon=True).start()
+
+    def announce(self, uid, details: dict):
+        """設備上線 (輪詢第一次讀到)：retained 已讀回就立即送 discovery，否則排隊等讀回"""
+        with self._announce_lock:
+            if not self._synced.is_set():
+                self._announce_pending[uid] = details
+                return
+        self.send_discovery([uid], {uid: details})
+
+    def _on_retained_config(self, topic, payload, retain):
+        if not retain or not payload: return
+        parts = topic.split('/')
+        if not parts[-2].startswith(f"{self.node_id}_mppt_") and not parts[-3].startswith(f"{self.node_id}_mppt_"): return
+        self._retained[topic] = hashlib.sha1(payload).digest()
+        self._last_retained_at = time.monotonic()
+
+    def watch_ha_status(self, unit_ids: set, device_details: dict):
+        """訂閱 HA birth topic；unit_ids / device_details 傳參考，重送時取當下內容"""
+        def _on_status(topic, payload, retain):
+            # 訂閱時 broker 會補送 retained 的 online，那不是 HA 重啟，忽略
+            if retain or payload.decode('utf-8', 'ignore').strip() != "online": return
+            if self._replay_thread and self._replay_thread.is_alive(): return
+            logger.info("🐣 偵測到 Home Assistant 重新啟動，重送 discovery 與最後狀態")
+            with self.devices_lock: ids, details = sorted(unit_ids), dict(device_details)
+            self._replay_thread = threading.Thread(
+                target=self._replay, args=(ids, details), name="birth-replay", daemon=True)
+            self._replay_thread.start()
+        self.mqtt.add_handler(self.ha_status_topic, _on_status)
+
+    def _replay(self, unit_ids: list, device_details: dict):
+        """discovery 與狀態各佔重送時窗的一半，平均分散到每台設備，避免瞬間灌爆 broker"""
+        if not unit_ids: return
+        step = self.birth_replay_window / 2 / len(unit_ids)
+        self.mqtt.publish(self.global_avail_topic, "online", qos=1, retain=True)
+        for uid in unit_ids:
+            self.send_discovery([uid], device_details, force=True)
+            time.sleep(step)
+        for uid in unit_ids:
+            self.replay_state(uid)
+            time.sleep(step)
+        logger.info(f"🐣 已重送 {len(unit_ids)} 台設備的 discovery 與狀態")
+
+    def replay_state(self, uid):
+        """以快取的最後狀態無條件重送 (HA 重啟後 state topic 沒有 retained 值)"""
+        vals = self.last_state.get((uid, "state_b1"))
+        if vals: self.publish_values(uid, vals, force=True)
+        bits = self.last_state.get((uid, "state_bits"))
+        if bits: self.publish_bits(uid, bits, force=True)
+
+    def _publish_if_changed(self, topic, payload_str, digest, force: bool = False) -> bool:
+        if not force and self._retained.get(topic) == digest: return False
+        self.mqtt.publish(topic, payload_str, qos=1, retain=True)
+        self._retained[topic] = digest
+        return True
+
+    def _clear_retained(self, topic):
+        self.mqtt.publish(topic, "", qos=1, retain=True)
+        self._retained.pop(topic, None)
+
+    def _encoded_discovery(self, uid, details) -> list:
+        """每個 (uid, device_details) 只組一次 payload，並快取序列化結果與雜湊"""
+        cache_key = (uid, tuple(sorted(details.items())))
+        cached = self._discovery_cache.get(uid)
+        if cached and cached[0] == cache_key: return cached[1]
+        configs = self._build_discovery(uid, details)
+        if self.discovery_mode == "device":
+            configs = [(self._device_topic(uid), self._device_payload(uid, configs))] + \
+                      [(topic, None) for topic, _ in configs]  # 舊單實體 topic 只留著做遷移比對
+        encoded = []
+        for topic, payload in configs:
+            text = self._dumps(payload) if payload is not None else None
+            encoded.append((topic, text, hashlib.sha1(text.encode('utf-8')).digest() if text else None))
+        self._discovery_cache[uid] = (cache_key, encoded)
+        return encoded
+
+    def send_discovery(self, unit_ids: list, device_details: dict = {}, force: bool = False):
+        """force=True：不比對 retained 雜湊，全部重送 (HA birth 重送用)"""
+        logger.info(f"📤 發送 HA Discovery ({self.discovery_mode} 模式) 預計生成設備: {unit_ids}")
         for uid in unit_ids:
             try:
-                entity_base = f"{self.node_id}_mppt_{uid}"
-                dev_info = self._get_dev_info(uid)
                 details = device_details.get(uid, {'count': 1, 'type': 0, 'hw_max': 60.0})
-                
-                self.publish_device_availability(uid, "online")
-                self._pub_connectivity(uid, entity_base, dev_info)
-                
-                for item in self.rmap.B1_INFO:
-                    if "ha" in item: 
-                        self._pub(uid, entity_base, item, dev_info, "sensor", "state_b1")
-                
-                for key, item in self.rmap.B3_STATUS_BITS.items():
-                    item['key'] = key 
-                    self._pub(uid, entity_base, item, dev_info, "binary_sensor", "state_bits", is_bin=True)
-
-                if hasattr(self.rmap, 'CONTROL_SWITCHES'):
-                    for key, item in self.rmap.CONTROL_SWITCHES.items():
-                        item['key'] = key
-                        self._pub_switch(uid, entity_base, item, dev_info)
-                        
-                if hasattr(self.rmap, 'CONTROL_BUTTONS'):
-                    for key, item in self.rmap.CONTROL_BUTTONS.items():
-                        item['key'] = key
-                        self._pub_button(uid, entity_base, item, dev_info)
-                        
-                if hasattr(self.rmap, 'D0_PARAMS'):
-                    for code, item in self.rmap.D0_PARAMS.items():
-                        ha_type = item['ha']['type']
-                        if ha_type == 'number': 
-                            self._pub_number(uid, entity_base, item, dev_info, details)
-                        elif ha_type == 'select': 
-                            self._pub_select(uid, entity_base, item, dev_info)
-                        elif ha_type == 'text':  
-                            self._pub_text(uid, entity_base, item, dev_info)
-                
-                # 防洪機制：每建完一台休息 0.05 秒，避免 MQTT Broker 負載過高丟包
-                time.sleep(0.05)
-                logger.info(f"✅ 設備 #{uid} HA 實體配置發送成功")
+                encoded = self._encoded_discovery(uid, details)
+
+                self.publish_device_availability(uid, self._availability.get(uid, "online"))
+                sent = skipped = 0
+                if self.discovery_mode == "device":
+                    dev_topic, dev_text, dev_digest = encoded[0]
+                    # broker 上還留著舊的單實體 config 就走遷移：標記 migrate_discovery → 送設備 config → 清除舊 topic
+                    legacy = [t for t, _, _ in encoded[1:] if self.migrate_discovery or t in self._retained]
+                    for topic in legacy: self.mqtt.publish(topic, self._dumps({"migrate_discovery": True}), qos=1, retain=True)
+                    if self._publish_if_changed(dev_topic, dev_text, dev_digest, force): sent += 1
+                    else: skipped += 1
+                    for topic in legacy: self._clear_retained(topic)
+                    if legacy: logger.info(f"🔀 設備 #{uid} 已將 {len(legacy)} 則單實體 config 遷移至設備模式")
+                else:
+                    if self._device_topic(uid) in self._retained: self._clear_retained(self._device_topic(uid))
+                    for topic, text, digest in encoded:
+                        if self._publish_if_changed(topic, text, digest, force): sent += 1
+                        else: skipped += 1
+                logger.info(f"✅ 設備 #{uid} HA 實體配置完成 (送出 {sent}，未變更略過 {skipped})")
 
             except Exception as e:
                 # 就算這台報錯，也要印出錯誤並繼續下一台
                 logger.error(f"❌ 設備 #{uid} HA Discovery 建立失敗: {e}")
                 continue 
 
+    def _build_discovery(self, uid, details) -> list:
+        """產生單台設備所有實體的 (config topic, payload)，不直接發佈"""
+        entity_base = f"{self.node_id}_mppt_{uid}"
+        dev_info = self._get_dev_info(uid)
+        with self._collect_lock:
+            return self._collect_discovery(uid, entity_base, dev_info, details)
+
+    def _collect_discovery(self, uid, entity_base, dev_info, details) -> list:
+        self._collect = []
+        try:
+            self._pub_connectivity(uid, entity_base, dev_info)
+            
+            for item in self.rmap.B1_INFO:
+                if "ha" in item: 
+                    self._pub(uid, entity_base, item, dev_info, "sensor", "state_b1")
+            
+            for key, item in self.rmap.B3_STATUS_BITS.items():
+                item['key'] = key 
+                self._pub(uid, entity_base, item, dev_info, "binary_sensor", "state_bits", is_bin=True)
+
+            if hasattr(self.rmap, 'CONTROL_SWITCHES'):
+                for key, item in self.rmap.CONTROL_SWITCHES.items():
+                    item['key'] = key
+                    self._pub_switch(uid, entity_base, item, dev_info)
+                    
+            if hasattr(self.rmap, 'CONTROL_BUTTONS'):
+                for key, item in self.rmap.CONTROL_BUTTONS.items():
+                    item['key'] = key
+                    self._pub_button(uid, entity_base, item, dev_info)
+                    
+            if hasattr(self.rmap, 'D0_PARAMS'):
+                for code, item in self.rmap.D0_PARAMS.items():
+                    ha_type = item['ha']['type']
+                    if ha_type == 'number': 
+                        self._pub_number(uid, entity_base, item, dev_info, details)
+                    elif ha_type == 'select': 
+                        self._pub_select(uid, entity_base, item, dev_info)
+                    elif ha_type == 'text':  
+                        self._pub_text(uid, entity_base, item, dev_info)
+            return self._collect
+        finally:
+            self._collect = None
+
+    # 📦 Device-based discovery：一台控制器一則 retained config，實體放在 cmps 裡
+    def _device_topic(self, uid):
+        return f"{self.prefix}/device/{self.node_id}_mppt_{uid}/config"
+
+    def _device_payload(self, uid, configs) -> dict:
+        cmps = {}
+        for topic, payload in configs:
+            domain = topic.split('/')[-4]
+            cmp = {k: v for k, v in payload.items() if k not in ("device", "availability", "availability_mode")}
+            cmp["platform"] = domain
+            cmps[payload["unique_id"]] = cmp  # unique_id 與單實體模式相同，HA 會沿用原本的實體
+        return self._add_availability({
+            "device": self._get_dev_info(uid),
+            "origin": {"name": "ha-mppt-modbus-addon", "url": "https://github.com/loveflee/ha-mppt-modbus-addon"},
+            "components": cmps,
+        }, uid)
+
     def _get_dev_info(self, uid):
         return {
             "identifiers": [f"{self.node_id}_mppt_addr{uid}"],
@@ -106,6 +302,9 @@ class HAManager:
         return payload
 
     def _publish_config(self, topic, payload):
+        if self._collect is not None:
+            self._collect.append((topic, payload))
+            return
         self.mqtt.publish(topic, self._dumps(payload), qos=1, retain=True)
 
     def _pub_connectivity(self, uid, entity_base, dev_info):
@@ -126,6 +325,7 @@ class HAManager:
 
     def publish_device_availability(self, uid, status):
         topic = f"{self.base_topic}_{uid}/availability"
+        self._availability[uid] = status
         self.mqtt.publish(topic, status, qos=1, retain=True)
 
     def _pub(self, uid, entity_base, item, dev_info, domain, sub_topic, is_bin=False):
@@ -137,10 +337,10 @@ class HAManager:
             "unique_id": unique_id,
             "object_id": unique_id, 
             "device": dev_info,
-            "state_topic": f"{self.base_topic}/{uid}/{sub_topic}",
-            "value_template": f"{{{{ value_json.{key} }}}}",
         }
+        self._bind_state(payload, uid, key, sub_topic)
         if not is_bin and item.get('unit'): payload["unit_of_measurement"] = item['unit']
+        if self.expire_after: payload["expire_after"] = self.expire_after
         
         if item.get('ha'):
             ha_conf = item['ha']
@@ -164,8 +364,7 @@ class HAManager:
             "icon": item.get('icon', "mdi:toggle-switch")
         }
         if item.get('state_key'):
-            payload["state_topic"] = f"{self.base_topic}/{uid}/state_bits"
-            payload["value_template"] = f"{{{{ value_json.{item['state_key']} }}}}"
+            self._bind_state(payload, uid, item['state_key'], "state_bits")
         else: payload["optimistic"] = True
         
         if item.get('ha', {}).get('entity_category'):
@@ -221,8 +420,7 @@ class HAManager:
         }
         if item.get('unit'): payload["unit_of_measurement"] = item['unit']
         if ha_conf.get('link_b1'):
-            payload["state_topic"] = f"{self.base_topic}/{uid}/state_b1"
-            payload["value_template"] = f"{{{{ value_json.{ha_conf['link_b1']} }}}}"
+            self._bind_state(payload, uid, ha_conf['link_b1'], "state_b1")
             
         if ha_conf.get('entity_category'):
             payload["entity_category"] = ha_conf['entity_category']
@@ -244,8 +442,7 @@ class HAManager:
             "icon": ha_conf.get('icon', "mdi:format-list-bulleted")
         }
         if ha_conf.get('link_b1'):
-            payload["state_topic"] = f"{self.base_topic}/{uid}/state_b1"
-            payload["value_template"] = f"{{{{ value_json.{ha_conf['link_b1']} }}}}"
+            self._bind_state(payload, uid, ha_conf['link_b1'], "state_b1")
             
         # 👇 修正：將地圖的 optimistic 屬性正確推給 HA
         if ha_conf.get('optimistic'):
@@ -271,10 +468,9 @@ class HAManager:
             "object_id": unique_id,
             "device": dev_info,
             "command_topic": f"{self.cmd_base['text']}/{entity_base}/{key}/set",
-            "state_topic": f"{self.base_topic}/{uid}/state_b1", 
-            "value_template": f"{{{{ value_json.{state_key} }}}}",
             "icon": ha_conf.get('icon', "mdi:form-textbox")
         }
+        self._bind_state(payload, uid, state_key, "state_b1")
         if ha_conf.get('pattern'):
             payload["pattern"] = ha_conf.get('pattern')
             
@@ -283,13 +479,73 @@ class HAManager:
             
         self._publish_config(topic, self._add_availability(payload, uid))
 
-    def publish_state(self, uid, data, sub_topic):
+    def _state_topic(self, uid, key, sub_topic) -> str:
+        if self.state_mode == "raw": return f"{self.base_topic}/{uid}/raw/{key}"
+        if self.state_mode == "split" and sub_topic == "state_b1":
+            sub_topic = self._field_group.get(key, "state_rt")
+        return f"{self.base_topic}/{uid}/{sub_topic}"
+
+    def _bind_state(self, payload, uid, key, sub_topic):
+        """依 state topic 配置填入 state_topic / value_template (raw 模式不用模板)"""
+        payload["state_topic"] = self._state_topic(uid, key, sub_topic)
+        if self.state_mode != "raw":
+            payload["value_template"] = f"{{{{ value_json.{key} }}}}"
+
+    def publish_values(self, uid, vals: dict, force: bool = False, config_changed: bool = True):
+        """發佈 B1/B3 解碼結果；config_changed=False 時設定區段未到刷新時間就整段略過"""
+        if self.state_mode == "combined":
+            return self.publish_state(uid, vals, "state_b1", force=force)
+        self.last_state[(uid, "state_b1")] = vals
+        if self.state_mode == "raw":
+            return self._publish_raw(uid, vals, "raw_b1", force)
+        groups = {"state_rt": {}, "state_cfg": {}}
+        for key, val in vals.items():
+            groups[self._field_group.get(key, "state_rt")][key] = val
+        for sub_topic, data in groups.items():
+            if not data: continue
+            if sub_topic == "state_cfg" and not (force or config_changed or self.publish_filter.due(uid, sub_topic)):
+                continue
+            payload = self.publish_filter.apply(uid, sub_topic, data, force=force)
+            if payload is not None:
+                self.mqtt.publish(f"{self.base_topic}/{uid}/{sub_topic}", self._dumps(payload), qos=0, retain=False)
+
+    def publish_bits(self, uid, bits: dict, force: bool = False):
+        if self.state_mode == "raw":
+            self.last_state[(uid, "state_bits")] = bits
+            return self._publish_raw(uid, bits, "raw_bits", force)
+        self.publish_state(uid, bits, "state_bits", force=force)
+
+    def _publish_raw(self, uid, data, filter_key, force):
+        for key, val in self.publish_filter.apply_delta(uid, filter_key, data, force=force).items():
+            self.mqtt.publish(f"{self.base_topic}/{uid}/raw/{key}", "" if val is None else str(val), qos=0, retain=False)
+
+    def publish_state(self, uid, data, sub_topic, force: bool = False):
+        """force=True：跳過死區過濾 (例如寫入後回讀，HA 要立即看到新設定值)"""
         topic = f"{self.base_topic}/{uid}/{sub_topic}"
-        self.mqtt.publish(topic, self._dumps(data), qos=0, retain=False)
+        self.last_state[(uid, sub_topic)] = data
+        payload = self.publish_filter.apply(uid, sub_topic, data, force=force)
+        if payload is None: return
+        self.mqtt.publish(topic, self._dumps(payload), qos=0, retain=False)
+
+    def publish_transaction_result(self, uid, ok: list, failed: list):
+        """批次交易結果：{base_topic}/{uid}/transaction/result"""
+        self.mqtt.publish(f"{self.base_topic}/{uid}/transaction/result", self._dumps({"ok": ok, "failed": failed}), qos=0, retain=False)
+
+    def publish_command_result(self, uid, keys: list, result: str, reason: str = ""):
+        """單筆指令結果 (被拒絕 / 無回應)：{base_topic}/{uid}/command/result"""
+        self.mqtt.publish(f"{self.base_topic}/{uid}/command/result",
+                          self._dumps({"keys": keys, "result": result, "reason": reason}), qos=0, retain=False)
+
+    def get_last_state(self, uid, sub_topic) -> dict:
+        return self.last_state.get((uid, sub_topic), {})
     
     def clear_all_discovery(self, unit_ids: list):
         logger.info("🧹 正在執行 HA 實體清除...")
         for uid in unit_ids:
+            self._discovery_cache.pop(uid, None)
+            if self.discovery_mode == "device":
+                self._clear_retained(self._device_topic(uid))
+                continue
             entity_base = f"{self.node_id}_mppt_{uid}"
             self._clear(entity_base, "connectivity", "binary_sensor") 
             for item in self.rmap.B1_INFO:
@@ -307,5 +563,4 @@ class HAManager:
                     self._clear(entity_base, item['key'], ha_type)
 
     def _clear(self, entity_base, key, domain):
-        topic = f"{self.prefix}/{domain}/{entity_base}/{key}/config"
-        self.mqtt.publish(topic, "", qos=1, retain=True)
+        self._clear_retained(f"{self.prefix}/{domain}/{entity_base}/{key}/config")
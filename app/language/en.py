@@ -2,7 +2,16 @@
 # -*- coding: utf-8 -*-
 # 📌 Ampinvt MPPT - Register Map (English)
 
-B3_REALTIME = [] 
+# 0xB3 realtime-only reply (37 bytes): Byte 3-5 status bits, Byte 36 checksum
+B3_REALTIME = [
+    { "key": "pv_voltage", "name": "PV Voltage", "unit": "V", "scale": 10, "offset": 6, "length": 2, "signed": False, "ha": {"type": "sensor", "device_class": "voltage", "state_class": "measurement"} },
+    { "key": "battery_voltage", "name": "Battery Voltage", "unit": "V", "scale": 100, "offset": 8, "length": 2, "signed": False, "ha": {"type": "sensor", "device_class": "voltage", "state_class": "measurement"} },
+    { "key": "charge_current", "name": "Charge Current", "unit": "A", "scale": 100, "offset": 10, "length": 2, "signed": False, "ha": {"type": "sensor", "device_class": "current", "state_class": "measurement"} },
+    { "key": "internal_temp_1", "name": "Internal Temp", "unit": "°C", "scale": 10, "offset": 12, "length": 2, "signed": True, "ha": {"type": "sensor", "device_class": "temperature", "state_class": "measurement"} },
+    { "key": "external_temp_1", "name": "External Temp", "unit": "°C", "scale": 100, "offset": 16, "length": 2, "signed": True, "ha": {"type": "sensor", "device_class": "temperature", "state_class": "measurement"} },
+    { "key": "today_yield_wh", "name": "Today Yield", "unit": "Wh", "scale": 1, "offset": 20, "length": 4, "signed": False, "ha": {"type": "sensor", "device_class": "energy", "state_class": "total_increasing"} },
+    { "key": "total_yield_wh", "name": "Total Yield", "unit": "Wh", "scale": 1, "offset": 24, "length": 4, "signed": False, "ha": {"type": "sensor", "device_class": "energy", "state_class": "total_increasing"} },
+]
 
 B1_INFO = [
     { "key": "battery_type", "name": "Battery Type", "unit": None, "scale": 1, "offset": 8, "length": 1, "signed": False, "map": { 0: "Lead-Acid(Sealed)", 1: "Lead-Acid(Gel)", 2: "Lead-Acid(Flooded)", 3: "Lithium" }, "ha": {"type": "sensor", "icon": "mdi:car-battery"} },
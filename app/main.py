@@ -1,3 +1,4 @@
+import asyncio
 import time
 import yaml
 import signal
@@ -5,25 +6,49 @@ import sys
 import logging
 import importlib
 import os
-import struct
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from core_logging import setup_global_logging
-from core_mqtt import RobustMQTTClient 
-from core_tcp import RobustTCPClient
-from ampinvt_proto import AmpinvtProtocol 
-from command_handler import CommandHandler
+from core_mqtt import RobustMQTTClient, AsyncMQTTBridge
 from ha_manager import HAManager
+from bus_worker import BusWorker, AsyncBusWorker
+from command_handler import CommandHandler
+from state_snapshot import StateSnapshot
 
 logger = None
 mqtt_client = None
 ha_mgr = None
 app_config = None
+persist = None  # 關機前寫入持久化快取
+MAX_ERRORS = 20
 
 discovered_devices = set()
 device_details_cache = {}
 
+def _parse_unit_ids(raw) -> list:
+    """unit_ids 可為 list、"1,2,3" 字串或單一整數"""
+    if isinstance(raw, int): return [raw]
+    if isinstance(raw, str): return [int(x) for x in raw.split(',') if x.strip().isdigit()]
+    ids = []
+    for x in raw if isinstance(raw, list) else []:
+        try: ids.append(int(x))
+        except: pass
+    return ids
+
+def _parse_intervals(raw) -> dict:
+    """個別設備輪詢週期：{uid: 秒} 或 "uid:秒,uid:秒" 字串；0 或負值略過"""
+    raw = raw or {}
+    if isinstance(raw, str):
+        iv = {}
+        for pair in raw.split(','):
+            try:
+                k, v = pair.split(':')
+                iv[int(k)] = float(v)
+            except ValueError: pass
+        raw = iv
+    return {int(k): float(v) for k, v in raw.items() if float(v) > 0}
+
 def load_config():
     """載入設定，並處理黑名單預設值"""
     try:
@@ -31,6 +56,12 @@ def load_config():
         with open(config_path, "r") as f: config = yaml.safe_load(f)
         if 'system' not in config: config['system'] = {}
         if 'language' not in config['system']: config['system']['language'] = 'tw'
+        # 🟢 持久化快取 (設備規格 + 故障隔離狀態)；空字串 = 不使用
+        config['system']['cache_path'] = config['system'].get('cache_path', '/data/mppt_cache.json')
+        # 🟢 最後狀態快照 (原始封包，重啟後立即重送)；空字串 = 不使用
+        config['system']['snapshot_path'] = config['system'].get('snapshot_path', '/data/mppt_state.bin')
+        # 🟢 執行引擎：thread = 每個網關一條執行緒 (預設)；asyncio = 全部網關跑在同一個事件迴圈
+        if config['system'].get('engine') not in ('thread', 'asyncio'): config['system']['engine'] = 'thread'
         
         # 🟢 處理黑名單設定
         if 'blacklist' not in config: config['blacklist'] = {}
@@ -38,21 +69,54 @@ def load_config():
         config['blacklist']['isolation_time'] = config['blacklist'].get('isolation_time', 60)
         config['blacklist']['long_delay_threshold'] = config['blacklist'].get('long_delay_threshold', 10)
         config['blacklist']['long_delay'] = config['blacklist'].get('long_delay', 3600)
+
+        # 🟢 輪詢設定：每 N 輪才讀一次完整 B1，其餘走 B3 快速路徑
+        if 'polling' not in config: config['polling'] = {}
+        config['polling']['poll_interval'] = config['polling'].get('poll_interval', 3)
+        config['polling']['delay_between_units'] = config['polling'].get('delay_between_units', 0.5)
+        config['polling']['full_refresh_cycles'] = max(1, int(config['polling'].get('full_refresh_cycles', 10)))
+        # 滑桿類指令 (number/select/text) 的防彈跳時間 (秒)，0 = 每則都寫
+        config['polling']['command_debounce'] = float(config['polling'].get('command_debounce', 0.4))
+        # 個別設備輪詢週期，格式 "uid:秒,uid:秒" (例如 "3:10,5:30")，未列出的用 poll_interval
+        config['polling']['unit_intervals'] = _parse_intervals(config['polling'].get('unit_intervals'))
         
+        # 🟢 Delta 發佈：死區 (0 = 只要有變就送) 與完整刷新週期 (秒)
+        if 'publish' not in config: config['publish'] = {}
+        for opt, default in (('deadband_voltage', 0.05), ('deadband_current', 0.1), ('deadband_power', 1.0),
+                             ('deadband_temperature', 0.2), ('full_refresh_interval', 300), ('expire_after', 0)):
+            config['publish'][opt] = config['publish'].get(opt, default)
+
+        # 🟢 MQTT 發佈節流：每秒訊息數 (0 = 不限)、突發量、QoS1 在途上限
+        mqtt = config.setdefault('mqtt', {})
+        mqtt['publish_rate'] = float(mqtt.get('publish_rate', 0))
+        mqtt['publish_burst'] = float(mqtt.get('publish_burst', 100))
+        mqtt['max_inflight'] = int(mqtt.get('max_inflight', 20))
+
         modbus = config.get('modbus', {})
-        raw = modbus.get('unit_ids', [1])
-        if isinstance(raw, list):
-            ids = []
-            for x in raw:
-                try: ids.append(int(x))
-                except: pass
-            modbus['unit_ids'] = ids if ids else [1]
-        elif isinstance(raw, str):
-            modbus['unit_ids'] = [int(x) for x in raw.split(',') if x.strip().isdigit()]
-        elif isinstance(raw, int):
-            modbus['unit_ids'] = [raw]
-        else:
-            modbus['unit_ids'] = [1]
+        modbus['unit_ids'] = _parse_unit_ids(modbus.get('unit_ids', [1])) or [1]
+        # 🟢 自適應逾時：timeout 為上限，min_timeout 為下限
+        modbus['timeout'] = float(modbus.get('timeout', 3.0))
+        modbus['adaptive_timeout'] = modbus.get('adaptive_timeout', True)
+        modbus['min_timeout'] = float(modbus.get('min_timeout', 0.3))
+        # 🟢 探測逾時：隔離期滿、尚未確認恢復的設備只給這麼短的等待
+        modbus['probe_timeout'] = float(modbus.get('probe_timeout', 0.5))
+
+        # 🟢 多網關：每個網關一條總線執行緒，未填的欄位沿用上面的單一網關 / polling 設定；沒設定 = 只有單一網關
+        #    unit id 必須全域唯一 (HA 實體與快照都以 unit id 區分)，重複的只留第一個網關
+        gateways, seen = [], set()
+        for gw in modbus.get('gateways') or [{}]:
+            g = {'host': gw.get('host', modbus.get('host')), 'port': int(gw.get('port', modbus.get('port', 502)))}
+            for opt in ('timeout', 'min_timeout', 'probe_timeout'): g[opt] = float(gw.get(opt, modbus[opt]))
+            g['adaptive_timeout'] = gw.get('adaptive_timeout', modbus['adaptive_timeout'])
+            for opt in ('poll_interval', 'delay_between_units'): g[opt] = float(gw.get(opt, config['polling'][opt]))
+            g['unit_intervals'] = {**config['polling']['unit_intervals'], **_parse_intervals(gw.get('unit_intervals'))}
+            ids = _parse_unit_ids(gw['unit_ids']) if 'unit_ids' in gw else modbus['unit_ids']
+            dup = [u for u in ids if u in seen]
+            if dup: print(f"⚠️ 網關 {g['host']}:{g['port']} 的 unit id {dup} 已屬於其他網關，略過")
+            g['unit_ids'] = [u for u in dict.fromkeys(ids) if u not in seen]
+            seen.update(g['unit_ids'])
+            if g['unit_ids']: gateways.append(g)
+        modbus['gateways'] = gateways
         config['modbus'] = modbus
         return config
     except Exception as e:
@@ -66,32 +130,77 @@ def graceful_exit(signum, frame):
         if app_config.get('mqtt', {}).get('reset_discovery_on_exit'):
             try: ha_mgr.clear_all_discovery(list(discovered_devices)); time.sleep(1)
             except: pass
+    if persist:
+        try: persist()
+        except Exception: pass
     if mqtt_client:
         logger.info("👋 系統關閉，發送全域離線 LWT")
         mqtt_client.publish(ha_mgr.global_avail_topic, "offline", retain=True)
+        mqtt_client.flush(3.0)
     sys.exit(0)
 
-def scan_single_device(protocol, uid, rmap):
-    """啟動時，掃描單個設備以識別類型，只嘗試 3 次"""
-    MAX_RETRIES = 3
-    for attempt in range(MAX_RETRIES):
+def route_command(msg, owner: dict):
+    """MQTT 指令依 unit id 交給所屬網關的 worker"""
+    if isinstance(msg, dict): t, p = msg.get('topic'), msg.get('payload')
+    else: t, p = getattr(msg, 'topic', None), getattr(msg, 'payload', None)
+    if not t or p is None: return
+    p_str = p.decode('utf-8').strip() if isinstance(p, bytes) else str(p).strip()
+    uid = CommandHandler._parse_topic(t)[0]
+    if uid is None: return
+    worker = owner.get(uid)
+    if not worker:
+        logger.warning(f"⚠️ 設備 #{uid} 不屬於任何網關，忽略指令: {t}")
+        return
+    logger.info(f"⚡ 插隊指令: {t} -> {p_str}")
+    worker.submit(t, p_str)
+
+def watchdog(workers: list, stats_tick: float) -> float:
+    """定期統計；全部網關都長時間無回應才重啟 (單一網關斷線由它自己的退避處理)。回傳下一次統計時間"""
+    now = time.monotonic()
+    if now >= stats_tick:
+        stats_tick = now + 300
+        ps = mqtt_client.publish_stats()
+        logger.debug(f"🚦 MQTT 已送 {ps['sent']}，佇列 {ps['queued']}，在途 {ps['inflight']}，"
+                     f"ack 平均 {ps['ack_avg']}s / 最大 {ps['ack_max']}s")
+    if all(w.consecutive_errors >= MAX_ERRORS for w in workers):
+        logger.critical("❌ 系統嚴重通訊故障，強制重啟")
+        mqtt_client.publish(ha_mgr.global_avail_topic, "offline", retain=True)
+        mqtt_client.flush(3.0)
+        sys.exit(1)
+    return stats_tick
+
+def run_threads(workers: list, owner: dict):
+    """同步引擎：每個網關一條執行緒，主執行緒只負責分派 MQTT 指令"""
+    for w in workers: w.start()
+    stats_tick = time.monotonic() + 300
+    while True:
         try:
-            data = protocol.read_b1_data(uid)
-            if data:
-                b_type = data[8]; b_count = data[10]; hw_max_raw = struct.unpack('>H', data[24:26])[0]
-                hw_max_amp = round(hw_max_raw / 100.0, 1)
-                if 1 <= b_count <= 16:
-                    t_map = rmap.B1_INFO[0].get('map', {})
-                    t_str = t_map.get(b_type, str(b_type))
-                    logger.info(f"✅ 設備 #{uid} 識別成功: {t_str}, {b_count}S, Max {hw_max_amp}A")
-                    return { "count": b_count, "type": b_type, "hw_max": hw_max_amp }
-        except Exception: pass
-        time.sleep(0.5)
-    logger.warning(f"⚠️ 設備 #{uid} 啟動掃描失敗 (無回應)，暫不註冊，等待上線...")
-    return None
+            mqtt_client.msg_event.wait(1.0)
+            mqtt_client.msg_event.clear()  # 先清再取，取完之後才到的指令會再次設起
+            while not mqtt_client.msg_queue.empty(): route_command(mqtt_client.msg_queue.get(), owner)
+            stats_tick = watchdog(workers, stats_tick)
+        except Exception as e:
+            logger.error(f"主迴圈發生意外錯誤: {e}")
+            time.sleep(1)
+
+async def run_async(workers: list, owner: dict):
+    """asyncio 引擎：所有網關的輪詢、指令與 MQTT 分派都在同一個事件迴圈"""
+    bridge = AsyncMQTTBridge(mqtt_client, asyncio.get_running_loop())
+    for w in workers: w.start()
+    stats_tick = time.monotonic() + 300
+    try:
+        while True:
+            try:
+                msg = await bridge.get(timeout=1.0)
+                if msg is not None: route_command(msg, owner)
+                stats_tick = watchdog(workers, stats_tick)
+            except Exception as e:
+                logger.error(f"主迴圈發生意外錯誤: {e}")
+                await asyncio.sleep(1)
+    finally: bridge.close()
 
 def main():
-    global mqtt_client, ha_mgr, app_config, logger, discovered_devices, device_details_cache
+    global mqtt_client, ha_mgr, app_config, logger, discovered_devices, device_details_cache, persist
     
     app_config = load_config()
     if not app_config: sys.exit(1)
@@ -99,12 +208,7 @@ def main():
     sys_cfg = app_config.get('system', {})
     debug_mode = sys_cfg.get('debug', False)
     lang = sys_cfg.get('language', 'tw')
-    
-    BL_CFG = app_config['blacklist']
-    FAIL_THRESHOLD = BL_CFG['fail_threshold']
-    INITIAL_DELAY = BL_CFG['isolation_time']
-    LONG_DELAY_THRESHOLD = BL_CFG['long_delay_threshold']
-    LONG_DELAY = BL_CFG['long_delay']
+    FULL_REFRESH_CYCLES = app_config['polling']['full_refresh_cycles']
 
     setup_global_logging(debug_mode)
     logger = logging.getLogger("Main")
@@ -124,146 +228,65 @@ def main():
     signal.signal(signal.SIGINT, graceful_exit)
     signal.signal(signal.SIGTERM, graceful_exit)
 
-    tcp = RobustTCPClient(modbus_cfg['host'], modbus_cfg['port'], modbus_cfg['timeout'])
-    mqtt_client = RobustMQTTClient(mqtt_cfg['broker'], mqtt_cfg['port'], mqtt_cfg['username'], mqtt_cfg['password'])
-    protocol = AmpinvtProtocol(tcp, debug=debug_mode)
-    ha_mgr = HAManager(mqtt_client, mqtt_cfg, rmap)
-    cmd_handler = CommandHandler(protocol, ha_mgr, rmap, timezone_offset=sys_cfg.get('timezone_offset', 8))
+    mqtt_client = RobustMQTTClient(mqtt_cfg['broker'], mqtt_cfg['port'], mqtt_cfg['username'], mqtt_cfg['password'],
+                                   publish_rate=mqtt_cfg['publish_rate'], publish_burst=mqtt_cfg['publish_burst'],
+                                   max_inflight=mqtt_cfg['max_inflight'])
+    ha_mgr = HAManager(mqtt_client, mqtt_cfg, rmap, publish_cfg=app_config['publish'])
 
-    initial_online_ids = []
-    logger.info("🔍 執行啟動掃描...")
-    for uid in modbus_cfg['unit_ids']:
-        details = scan_single_device(protocol, uid, rmap)
-        if details:
-            device_details_cache[uid] = details
-            initial_online_ids.append(uid)
-            discovered_devices.add(uid)
+    if bool(getattr(rmap, 'B3_REALTIME', None)) and FULL_REFRESH_CYCLES > 1:
+        logger.info(f"⚡ 啟用 B3 快速輪詢，每 {FULL_REFRESH_CYCLES} 輪讀一次完整 B1")
 
     logger.info(f"👻 設定全域 LWT: {ha_mgr.global_avail_topic}")
     mqtt_client.set_lwt(ha_mgr.global_avail_topic, payload="offline", retain=True)
 
-    def on_mqtt_ready():
-        if initial_online_ids:
-            ha_mgr.send_discovery(initial_online_ids, device_details_cache)
-            for uid in initial_online_ids:
-                ha_mgr.publish_connectivity_state(uid, True)
+    def on_mqtt_ready(reconnect=False):
+        # 單純的 broker 重連只需重新訂閱 (discovery 與設備可用性都是 retained)；
+        # HA 自己重啟時由 homeassistant/status 的 birth message 觸發重送
+        if not reconnect:
+            # 先讀回 broker 上的 retained config，內容沒變的不重送 (在背景執行緒完成)；
+            # 讀回前就已上線的設備排在 announce 佇列，讀回後一起送
+            ha_mgr.sync_discovery([], device_details_cache)
         
+        # 全域 LWT 在斷線時已被 broker 改成 offline，每次連上都要補回 online
         mqtt_client.publish(ha_mgr.global_avail_topic, "online", retain=True)
+        ha_mgr.watch_ha_status(discovered_devices, device_details_cache)
         # 👇 修正：補上 "text" 網域訂閱
         for t in ["switch", "button", "number", "select", "text"]:
             mqtt_client.subscribe(f"{mqtt_cfg['discovery_prefix']}/{t}/+/+/set")
+        # 📦 批次參數交易 (JSON)
+        mqtt_client.subscribe(f"{ha_mgr.base_topic}/+/transaction")
         logger.info("👂 MQTT 準備就緒")
 
     mqtt_client.on_connected_callback = on_mqtt_ready
     mqtt_client.connect()
 
-    consecutive_errors = 0    
-    MAX_ERRORS = 20
-    
-    current_ts = time.time()
-    offline_devices = {}
-    device_fail_counts = {}
-
-    for uid in modbus_cfg['unit_ids']:
-        device_fail_counts[uid] = 0
-        if uid not in discovered_devices:
-            offline_devices[uid] = current_ts 
-
-    def process_commands():
-        count = 0
-        while not mqtt_client.msg_queue.empty():
-            msg = mqtt_client.msg_queue.get()
-            if isinstance(msg, dict): t, p = msg.get('topic'), msg.get('payload')
-            else: t, p = getattr(msg, 'topic', None), getattr(msg, 'payload', None)
-            if not t or p is None: continue
-            p_str = p.decode('utf-8').strip() if isinstance(p, bytes) else str(p).strip()
-            logger.info(f"⚡ 插隊指令: {t} -> {p_str}")
-            cmd_handler.process_message(t, p_str)
-            count += 1
-        return count
-
-    while True:
-        try:
-            any_success = False 
-            current_time = time.time()
-
-            process_commands()
+    snapshot = None
+    if sys_cfg.get('snapshot_path') and os.path.isdir(os.path.dirname(sys_cfg['snapshot_path']) or '.'):
+        try: snapshot = StateSnapshot(sys_cfg['snapshot_path'])
+        except OSError as e: logger.warning(f"⚠️ 無法開啟狀態快照 {sys_cfg['snapshot_path']}: {e}")
 
-            for uid in modbus_cfg['unit_ids']:
-                
-                if uid in offline_devices:
-                    if current_time < offline_devices[uid]: continue 
-                    else: logger.info(f"🔄 嘗試聯繫設備 #{uid} ...")
+    # 🚌 每個網關一個 worker (各自的 TCP 連線、排程、故障隔離)；MQTT client 與 HAManager 共用
+    worker_cls = AsyncBusWorker if sys_cfg['engine'] == 'asyncio' else BusWorker
+    logger.info(f"🧵 執行引擎: {sys_cfg['engine']}")
+    workers = [worker_cls(gw, app_config, rmap, ha_mgr, discovered_devices, device_details_cache,
+                          snapshot=snapshot, debug=debug_mode) for gw in modbus_cfg['gateways']]
+    if not workers:
+        logger.critical("❌ 沒有任何可輪詢的網關 / 設備，請檢查 modbus 設定")
+        sys.exit(1)
+    owner = {uid: w for w in workers for uid in w.unit_ids}
+    if len(workers) > 1:
+        for w in workers: logger.info(f"🚌 網關 {w.name}: 設備 {w.unit_ids}")
 
-                if process_commands() > 0: time.sleep(0.2)
+    def save_state():
+        for w in workers:
+            try: w.save()
+            except Exception as e: logger.warning(f"⚠️ 網關 {w.name} 快取寫入失敗: {e}")
+        if snapshot: snapshot.flush()
+    persist = save_state
 
-                try:
-                    raw_data = protocol.read_b1_data(uid)
-                    if raw_data:
-                        if uid not in discovered_devices:
-                            logger.info(f"🎉 發現新上線設備 #{uid}！")
-                            b_type = raw_data[8]; b_count = raw_data[10]; hw_max = round(struct.unpack('>H', raw_data[24:26])[0] / 100.0, 1)
-                            if 1 <= b_count <= 16:
-                                details = {"count": b_count, "type": b_type, "hw_max": hw_max}
-                                device_details_cache[uid] = details
-                                ha_mgr.send_discovery([uid], device_details_cache)
-                                discovered_devices.add(uid)
-                                ha_mgr.publish_connectivity_state(uid, True)
-                            else: raise Exception("Invalid Data")
-
-                        vals = protocol.decode(raw_data, rmap.B1_INFO)
-                        bits = protocol.decode(raw_data, rmap.B3_STATUS_BITS, is_bits=True)
-                        ha_mgr.publish_state(uid, vals, "state_b1")
-                        ha_mgr.publish_state(uid, bits, "state_bits")
-                        
-                        if device_fail_counts.get(uid, 0) > 0:
-                            logger.info(f"✅ 設備 #{uid} 連線恢復")
-                            device_fail_counts[uid] = 0
-                            ha_mgr.publish_device_availability(uid, "online")
-                            ha_mgr.publish_connectivity_state(uid, True)
-
-                        if uid in offline_devices: del offline_devices[uid]
-                        any_success = True
-                    else:
-                        raise Exception("Empty Data") 
-                    time.sleep(app_config['polling']['delay_between_units'])
-
-                except Exception:
-                    fail_count = device_fail_counts.get(uid, 0) + 1
-                    device_fail_counts[uid] = fail_count
-                    
-                    delay = INITIAL_DELAY
-                    
-                    if fail_count >= LONG_DELAY_THRESHOLD:
-                        if fail_count == LONG_DELAY_THRESHOLD:
-                             logger.error(f"❌ 設備 #{uid} 連續失敗達 {LONG_DELAY_THRESHOLD} 次！進入【懲罰性隔離】{LONG_DELAY} 秒。")
-                        delay = LONG_DELAY
-                    
-                    if fail_count == FAIL_THRESHOLD:
-                        logger.error(f"❌ 設備 #{uid} 連續失敗 {FAIL_THRESHOLD} 次，標記為【離線】")
-                        ha_mgr.publish_device_availability(uid, "offline")
-                        ha_mgr.publish_connectivity_state(uid, False)
-                    
-                    offline_devices[uid] = current_time + delay
-            
-            if any_success or len(offline_devices) < len(modbus_cfg['unit_ids']):
-                consecutive_errors = 0 
-            else:
-                consecutive_errors += 1 
-                if consecutive_errors % 5 == 0:
-                    logger.warning(f"⚠️ 所有設備皆無回應 ({consecutive_errors}/{MAX_ERRORS})")
-
-            if consecutive_errors >= MAX_ERRORS:
-                logger.critical("❌ 系統嚴重通訊故障，強制重啟")
-                mqtt_client.publish(ha_mgr.global_avail_topic, "offline", retain=True)
-                sys.exit(1)
-
-        except Exception as e:
-            logger.error(f"主迴圈發生意外錯誤: {e}")
-            consecutive_errors += 1
-            time.sleep(1)
-            
-        time.sleep(app_config['polling']['poll_interval'])
+    for w in workers: w.restore()
+    if sys_cfg['engine'] == 'asyncio': asyncio.run(run_async(workers, owner))
+    else: run_threads(workers, owner)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,64 @@
+# 狀態發佈過濾：死區 + 定期完整刷新
+import time
+
+_MISSING = object()
+
+class PublishFilter:
+    """
+    📉 狀態 Delta 發佈過濾器
+    🔥 每台設備 × 每個 state topic 記住上次「實際送出」的內容。
+    🔥 沒有任何欄位超出死區 (例如 ±0.05 V、±0.1 A) 就不發佈；有欄位超出時仍送完整 JSON，
+       但未超出死區的欄位沿用上次送出的值，HA 的 recorder 不會被雜訊洗版。
+    🔥 每 full_refresh 秒無條件送一次真實完整快照，把被死區壓住的值校正回來，也讓 expire_after 不會誤判。
+    """
+    def __init__(self, deadbands: dict = None, full_refresh: float = 300, clock=time.monotonic):
+        self.deadbands = deadbands or {}
+        self.full_refresh = full_refresh
+        self.clock = clock
+        self._sent = {}     # (uid, sub_topic) -> dict
+        self._full_at = {}  # (uid, sub_topic) -> 上次完整快照時間
+        self.skipped = 0
+
+    def _moved(self, key, new, old) -> bool:
+        if old is _MISSING or old is None or new is None: return old is not new
+        if new == old: return False
+        band = self.deadbands.get(key)
+        if band and isinstance(new, (int, float)) and isinstance(old, (int, float)):
+            return abs(new - old) >= band - 1e-9
+        return True
+
+    def due(self, uid, sub_topic) -> bool:
+        """此 topic 是否從未送過或已到完整刷新時間"""
+        k = (uid, sub_topic)
+        if k not in self._sent: return True
+        return bool(self.full_refresh) and self.clock() - self._full_at.get(k, 0) >= self.full_refresh
+
+    def _process(self, uid, sub_topic, data: dict, force: bool):
+        """回傳 (要送出的完整 dict, 本次變動的欄位 dict)；不需發佈時回傳 (None, None)"""
+        k = (uid, sub_topic)
+        sent = self._sent.get(k)
+        if force or self.due(uid, sub_topic):
+            self._sent[k] = dict(data)
+            self._full_at[k] = self.clock()
+            return data, data
+
+        out, changed = {}, {}
+        for key, val in data.items():
+            old = sent.get(key, _MISSING)
+            if self._moved(key, val, old):
+                out[key] = changed[key] = val
+            else:
+                out[key] = old
+        if not changed:
+            self.skipped += 1
+            return None, None
+        self._sent[k] = out
+        return out, changed
+
+    def apply(self, uid, sub_topic, data: dict, force: bool = False):
+        """回傳應送出的完整 dict；不需發佈時回傳 None"""
+        return self._process(uid, sub_topic, data, force)[0]
+
+    def apply_delta(self, uid, sub_topic, data: dict, force: bool = False) -> dict:
+        """只回傳需要送出的欄位 (完整刷新時為全部欄位)，給每個 key 各自一個 topic 的模式用"""
+        return self._process(uid, sub_topic, data, force)[1] or {}
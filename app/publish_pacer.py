@@ -0,0 +1,157 @@
+# MQTT 發佈節流：Token Bucket + QoS1 在途上限
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger("Pacer")
+
+class TokenBucket:
+    """🪣 每秒補 rate 個 token，最多存 burst 個；rate <= 0 表示不限速"""
+    def __init__(self, rate: float, burst: float, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.clock = clock
+        self.tokens = self.burst
+        self._at = clock()
+
+    def wait_time(self) -> float:
+        """取一個 token 需要再等幾秒 (0 = 已取得)"""
+        if self.rate <= 0: return 0.0
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._at) * self.rate)
+        self._at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class PublishPacer:
+    """
+    🚦 背景發佈執行緒
+    🔥 publish() 只把訊息排進佇列立即返回，送出順序不變；由單一執行緒依 token bucket 控制速率。
+    🔥 QoS1 訊息追蹤 MQTTMessageInfo.mid，在途 (未收到 PUBACK) 達 max_inflight 就先等 ack，不會壓垮小型 broker。
+    🔥 統計佇列深度、在途數與 ack 延遲 (EWMA / 最大值)，大量設備時以 broker 實際能力全速發佈，不再固定 sleep。
+    🔥 斷線期間只排隊不送：
+       狀態 (QoS0、非 retained) 同一 topic 只留最新一則，原位覆蓋；
+       availability / discovery (retained 或 QoS1) 一律依送入順序排隊，只略過與佇列中最新一則完全相同的重複訊息，
+       遷移標記 → 新 config → 清除舊 config 的順序不會被打亂。重連後由節流執行緒一次送完。
+    """
+    ACK_TIMEOUT = 30.0  # 超過這麼久沒 ack 的在途訊息視為遺失 (例如斷線)，不再佔用名額
+
+    def __init__(self, client, rate: float = 0, burst: float = 100, max_inflight: int = 20, clock=time.monotonic):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.max_inflight = max(1, int(max_inflight))
+        self.clock = clock
+        self._queue = collections.deque()  # [topic, payload, qos, retain]
+        self._latest = {}        # topic -> 佇列中該 topic 最新的那一則
+        self.connected = False
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        self._inflight = {}      # mid -> 送出時間
+        self._early_acks = {}    # publish() 還沒返回就先收到的 ack (QoS0 的 on_publish 也會進來，定期清掉)
+        self.sent = 0
+        self.ack_avg = 0.0
+        self.ack_max = 0.0
+        self._thread = threading.Thread(target=self._run, name="mqtt-pacer", daemon=True)
+        self._thread.start()
+
+    def submit(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        with self._cond:
+            old = self._latest.get(topic)
+            if old is not None:
+                if old[1:] == [payload, qos, retain]:
+                    self.coalesced += 1  # 與佇列中最新一則完全相同
+                    return
+                if qos == 0 and not retain and old[2] == 0 and not old[3]:
+                    self.coalesced += 1
+                    old[1] = payload  # 狀態：原位換成最新值
+                    return
+            # 有順序意義的訊息 (retained / QoS1) 一律排到最後，不丟棄內容不同的舊訊息
+            entry = [topic, payload, qos, retain]
+            self._queue.append(entry)
+            self._latest[topic] = entry
+            self._cond.notify_all()
+
+    def set_connected(self, connected: bool):
+        with self._cond:
+            self.connected = connected
+            if connected and self._queue:
+                logger.info(f"📤 MQTT 重新連線，補送 {len(self._queue)} 則暫存訊息 (已合併 {self.coalesced} 則)")
+            self._cond.notify_all()
+
+    def on_publish(self, mid):
+        """paho on_publish callback (網路執行緒)；不可在持有 paho 鎖時等待本物件以外的東西"""
+        now = self.clock()
+        with self._cond:
+            sent_at = self._inflight.pop(mid, None)
+            if sent_at is None:
+                self._early_acks[mid] = now
+                return
+            self._record_ack(now - sent_at)
+            self._cond.notify_all()
+
+    def _record_ack(self, latency: float):
+        self.ack_avg = latency if not self.ack_avg else self.ack_avg * 0.9 + latency * 0.1
+        if latency > self.ack_max: self.ack_max = latency
+
+    def _prune(self, now: float):
+        if len(self._early_acks) > 256:
+            self._early_acks = {mid: t for mid, t in self._early_acks.items() if now - t < 1.0}
+        stale = [mid for mid, t in self._inflight.items() if now - t > self.ACK_TIMEOUT]
+        for mid in stale: del self._inflight[mid]
+        if stale: logger.warning(f"⚠️ {len(stale)} 則 QoS1 訊息 {self.ACK_TIMEOUT:.0f}s 未收到 ack，釋放在途名額")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue or not self.connected:
+                    self._cond.wait()
+                entry = self._queue[0]
+                topic, qos, retain = entry[0], entry[2], entry[3]
+                if qos > 0:
+                    while len(self._inflight) >= self.max_inflight:
+                        self._cond.wait(1.0)
+                        self._prune(self.clock())
+            wait = self.bucket.wait_time()
+            while wait > 0:
+                time.sleep(wait)
+                wait = self.bucket.wait_time()
+
+            # 只有這個執行緒會取出，佇列頭在送出後才移除，flush() 不會看到「已取出未送出」的空窗
+            with self._cond:
+                payload = entry[1]  # 等 token 期間狀態可能被原位換成更新的值
+                if self._latest.get(topic) is entry: del self._latest[topic]
+            sent_at = self.clock()
+            info = None
+            try:
+                info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            except Exception as e:
+                logger.warning(f"⚠️ Publish 失敗 ({topic}): {e}")
+            with self._cond:
+                if self._queue and self._queue[0] is entry: self._queue.popleft()
+                self._cond.notify_all()
+                if info is None: continue
+                self.sent += 1
+                if qos > 0:
+                    if self._early_acks.pop(info.mid, None) is not None:
+                        self._record_ack(self.clock() - sent_at)
+                    else: self._inflight[info.mid] = sent_at
+                self._prune(self.clock())
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等佇列送完且在途 QoS1 都收到 ack (關機前用)"""
+        deadline = self.clock() + timeout
+        with self._cond:
+            while self._queue or self._inflight:
+                left = deadline - self.clock()
+                if left <= 0: return False
+                self._cond.wait(min(left, 0.1))
+        return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"queued": len(self._queue), "inflight": len(self._inflight), "sent": self.sent,
+                    "coalesced": self.coalesced,
+                    "ack_avg": round(self.ack_avg, 3), "ack_max": round(self.ack_max, 3)}
@@ -0,0 +1,89 @@
+# 輪詢排程器 (Deadline 驅動)
+import heapq
+import logging
+import time
+
+logger = logging.getLogger("Sched")
+
+class PollScheduler:
+    """
+    ⏱️ 固定速率輪詢排程器
+    🔥 每台設備各自有 next_due，用 heap 取出最早到期者，不再「讀完全部 + 睡滿 poll_interval」。
+    🔥 下一次到期 = 本次「預定」時間 + interval (不是完成時間)，週期不會越跑越長。
+    🔥 落後超過一整個 interval 時跳過錯過的槽位 (不補跑)，並記入 overrun 統計。
+    """
+    def __init__(self, default_interval: float, clock=time.monotonic):
+        self.default_interval = float(default_interval)
+        self.clock = clock
+        self._heap = []        # (due, seq, uid)
+        self._due = {}         # uid -> 目前有效的 due (heap 內舊項目用 lazy delete)
+        self._intervals = {}
+        self._running = {}     # uid -> 本次執行的預定時間
+        self._last_start = {}
+        self._seq = 0
+        self.overruns = {}
+        self.avg_period = {}
+
+    def add(self, uid, interval: float = None, offset: float = 0.0):
+        self._intervals[uid] = float(interval or self.default_interval)
+        self.overruns.setdefault(uid, 0)
+        self._push(uid, self.clock() + offset)
+
+    def interval(self, uid) -> float:
+        return self._intervals.get(uid, self.default_interval)
+
+    def _push(self, uid, due: float):
+        self._due[uid] = due
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, uid))
+
+    def _peek(self):
+        while self._heap:
+            due, _, uid = self._heap[0]
+            if self._due.get(uid) == due: return due, uid
+            heapq.heappop(self._heap)
+        return None, None
+
+    def next_due_time(self):
+        return self._peek()[0]
+
+    def pop_due(self, now: float = None):
+        """取出已到期的設備 (沒有則回傳 None)；取出後須呼叫 complete()"""
+        now = self.clock() if now is None else now
+        due, uid = self._peek()
+        if uid is None or due > now: return None
+        heapq.heappop(self._heap)
+        del self._due[uid]
+        self._running[uid] = due
+
+        last = self._last_start.get(uid)
+        if last is not None:
+            period = now - last
+            prev = self.avg_period.get(uid)
+            self.avg_period[uid] = period if prev is None else prev * 0.8 + period * 0.2
+        self._last_start[uid] = now
+        return uid
+
+    def complete(self, uid, now: float = None):
+        """本次輪詢結束，依固定速率排下一次 (含漂移補償與 overrun 計數)"""
+        now = self.clock() if now is None else now
+        anchor = self._running.pop(uid, now)
+        interval = self.interval(uid)
+        next_due = anchor + interval
+        if next_due <= now:
+            missed = int((now - anchor) // interval)
+            next_due = anchor + (missed + 1) * interval
+            self.overruns[uid] = self.overruns.get(uid, 0) + missed
+            logger.debug(f"設備 #{uid} 輪詢落後，跳過 {missed} 個週期 (累計 overrun {self.overruns[uid]})")
+        self._push(uid, next_due)
+
+    def defer(self, uid, delay: float):
+        """將設備的下一次輪詢往後延 (不影響其他設備)"""
+        self._running.pop(uid, None)
+        self._push(uid, self.clock() + delay)
+
+    def stats(self) -> dict:
+        return {uid: {"interval": self.interval(uid),
+                      "avg_period": round(self.avg_period.get(uid, 0.0), 3),
+                      "overruns": self.overruns.get(uid, 0)}
+                for uid in self._intervals}
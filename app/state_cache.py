@@ -0,0 +1,68 @@
+# 持久化快取：設備規格 + 故障隔離狀態 (熱重啟用)
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("Cache")
+
+class StateCache:
+    """
+    💾 存放在 /data 的 JSON 快取，以「網關 host:port」+ unit id 為 key
+    🔥 device_details (電池類型、串數、hw_max) 重啟後可立即送 discovery，不必等第一次讀取。
+    🔥 故障隔離狀態 (連續失敗次數、下次探測的牆上時間) 一起保存，已知的死位址重啟後仍維持退避。
+    🔥 寫入走暫存檔 + os.replace，斷電也不會留下半個檔案；內容沒變就不寫。
+       多個網關共用同一個檔案 (各佔一個 key)，讀-改-寫以類別鎖串行化。
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path: str, gateway: str):
+        self.path = path
+        self.gateway = gateway
+        self._last = None
+
+    def _read_all(self) -> dict:
+        try:
+            with open(self.path, "r") as f: data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError: return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ 快取檔讀取失敗，忽略: {e}")
+            return {}
+
+    def load(self) -> dict:
+        """回傳本網關的 {uid: {"details": {...} | None, "fails": int, "retry_in": 秒}}"""
+        units = {}
+        now = time.time()
+        for key, entry in self._read_all().get(self.gateway, {}).items():
+            try: uid = int(key)
+            except ValueError: continue
+            units[uid] = {"details": entry.get("details"), "fails": int(entry.get("fails", 0)),
+                          "retry_in": max(0.0, float(entry.get("retry_at", 0)) - now)}
+        if units: logger.info(f"💾 載入快取: {len(units)} 台設備 ({self.gateway})")
+        return units
+
+    def save(self, details: dict, health: dict):
+        """details：{uid: device_details}；health：{uid: (fails, 剩餘隔離秒數)}"""
+        now = time.time()
+        units = {}
+        for uid in set(details) | set(health):
+            fails, retry_in = health.get(uid, (0, 0.0))
+            units[str(uid)] = {"details": details.get(uid), "fails": fails, "retry_at": round(now + retry_in, 1)}
+        # 只比對內容 (不含時間戳變動)，避免每次都寫
+        fingerprint = json.dumps({u: (e["details"], e["fails"]) for u, e in units.items()}, sort_keys=True)
+        if fingerprint == self._last: return
+        with StateCache._lock:
+            data = self._read_all()
+            data[self.gateway] = units
+            tmp = f"{self.path}.tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                self._last = fingerprint
+            except OSError as e:
+                logger.warning(f"⚠️ 快取寫入失敗 ({self.path}): {e}")
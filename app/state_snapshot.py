@@ -0,0 +1,53 @@
+# 最後狀態快照：每台設備一筆固定長度紀錄 (mmap)
+import logging
+import mmap
+import os
+import struct
+import time
+
+from ampinvt_proto import B1_FRAME_LEN, B3_FRAME_LEN
+
+logger = logging.getLogger("Snapshot")
+
+class StateSnapshot:
+    """
+    📸 把每台設備最後一次的原始 B1 / B3 封包存進 mmap 檔案，重啟後立即解碼重送，HA 不必等第一次輪詢
+    🔥 存原始封包而不是 JSON：每筆固定 146 bytes (兩個時間戳 + 93 + 37)，slot 直接用 unit id 定位。
+    🔥 每次輪詢成功只是一次記憶體複製 (寫進 mmap)，不做 syscall；落盤交給作業系統，關機時 flush。
+    """
+    RECORD = struct.Struct(f">dd{B1_FRAME_LEN}s{B3_FRAME_LEN}s")
+    SLOTS = 256
+
+    def __init__(self, path: str):
+        self.path = path
+        size = self.RECORD.size * self.SLOTS
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)  # 格式不同 (或新檔) 就重建
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def record(self, uid: int, frame, is_b1: bool):
+        """輪詢成功時呼叫；frame 為收到的原始封包 (memoryview 也可)"""
+        if not 0 <= uid < self.SLOTS: return
+        base = uid * self.RECORD.size
+        if is_b1:
+            struct.pack_into(">d", self._mm, base, time.time())
+            self._mm[base + 16:base + 16 + B1_FRAME_LEN] = frame
+        else:
+            struct.pack_into(">d", self._mm, base + 8, time.time())
+            self._mm[base + 16 + B1_FRAME_LEN:base + self.RECORD.size] = frame
+
+    def load(self, uid: int):
+        """回傳 (b1 時間, b1 bytes, b3 時間, b3 bytes)；沒有 B1 紀錄回傳 None"""
+        if not 0 <= uid < self.SLOTS: return None
+        b1_at, b3_at, b1, b3 = self.RECORD.unpack_from(self._mm, uid * self.RECORD.size)
+        if not b1_at or b1[0] != uid: return None
+        return b1_at, b1, b3_at, (b3 if b3_at and b3[0] == uid else None)
+
+    def flush(self):
+        try: self._mm.flush()
+        except (OSError, ValueError) as e: logger.warning(f"⚠️ 快照寫入失敗: {e}")
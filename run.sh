@@ -14,6 +14,9 @@ if [ -f "$OPTIONS_PATH" ]; then
     RESET_ON_EXIT=$(jq -r '.reset_discovery_on_exit // false' "$OPTIONS_PATH")
 
     LANGUAGE=$(jq -r '.language // "tw"' "$OPTIONS_PATH")
+    CACHE_PATH=$(jq -r '.cache_path // "/data/mppt_cache.json"' "$OPTIONS_PATH")
+    SNAPSHOT_PATH=$(jq -r '.snapshot_path // "/data/mppt_state.bin"' "$OPTIONS_PATH")
+    ENGINE=$(jq -r '.engine // "thread"' "$OPTIONS_PATH")
 
     # 🟢 黑名單（故障懲罰）
     FAIL_THRESHOLD=$(jq -r '.blacklist.fail_threshold // 20' "$OPTIONS_PATH")
@@ -25,10 +28,15 @@ if [ -f "$OPTIONS_PATH" ]; then
     MODBUS_HOST=$(jq -r '.modbus.host // "192.168.106.12"' "$OPTIONS_PATH")
     MODBUS_PORT=$(jq -r '.modbus.port // 502' "$OPTIONS_PATH")
     MODBUS_TIMEOUT=$(jq -r '.modbus.timeout // 3.0' "$OPTIONS_PATH")
+    MODBUS_ADAPTIVE=$(jq -r '.modbus.adaptive_timeout // true' "$OPTIONS_PATH")
+    MODBUS_MIN_TIMEOUT=$(jq -r '.modbus.min_timeout // 0.3' "$OPTIONS_PATH")
+    MODBUS_PROBE_TIMEOUT=$(jq -r '.modbus.probe_timeout // 0.5' "$OPTIONS_PATH")
     MODBUS_RETRY=$(jq -r '.modbus.retry_delay // 2.0' "$OPTIONS_PATH")
 
     # unit_ids: "1,2,3" → [1,2,3]
     SLAVE_IDS=$(jq -r '.modbus.unit_ids // "1"' "$OPTIONS_PATH" | jq -R 'split(",") | map(select(length>0) | tonumber)')
+    # 多網關：整段 JSON 直接寫進 YAML (JSON 本身就是合法的 YAML)
+    GATEWAYS=$(jq -c '.modbus.gateways // []' "$OPTIONS_PATH")
 
     # 🟢 MQTT
     MQTT_HOST=$(jq -r '.mqtt.broker // "core-mosquitto"' "$OPTIONS_PATH")
@@ -38,10 +46,29 @@ if [ -f "$OPTIONS_PATH" ]; then
     DISC_PREFIX=$(jq -r '.mqtt.discovery_prefix // "homeassistant"' "$OPTIONS_PATH")
     NODE_ID=$(jq -r '.mqtt.node_id // "wifi01"' "$OPTIONS_PATH")
     DEVICE_NAME=$(jq -r '.mqtt.device_name // "ampinvt_mppt"' "$OPTIONS_PATH")
+    STATE_MODE=$(jq -r '.mqtt.state_topic_mode // "combined"' "$OPTIONS_PATH")
+    DISCOVERY_MODE=$(jq -r '.mqtt.discovery_mode // "entity"' "$OPTIONS_PATH")
+    MIGRATE_DISCOVERY=$(jq -r '.mqtt.migrate_discovery // false' "$OPTIONS_PATH")
+    HA_STATUS_TOPIC=$(jq -r '.mqtt.ha_status_topic // "homeassistant/status"' "$OPTIONS_PATH")
+    BIRTH_WINDOW=$(jq -r '.mqtt.birth_replay_window // 10' "$OPTIONS_PATH")
+    PUB_RATE=$(jq -r '.mqtt.publish_rate // 0' "$OPTIONS_PATH")
+    PUB_BURST=$(jq -r '.mqtt.publish_burst // 100' "$OPTIONS_PATH")
+    MAX_INFLIGHT=$(jq -r '.mqtt.max_inflight // 20' "$OPTIONS_PATH")
+
+    # 🟢 Delta 發佈
+    DB_VOLT=$(jq -r '.publish.deadband_voltage // 0.05' "$OPTIONS_PATH")
+    DB_CURR=$(jq -r '.publish.deadband_current // 0.1' "$OPTIONS_PATH")
+    DB_POWER=$(jq -r '.publish.deadband_power // 1.0' "$OPTIONS_PATH")
+    DB_TEMP=$(jq -r '.publish.deadband_temperature // 0.2' "$OPTIONS_PATH")
+    FULL_REFRESH_INT=$(jq -r '.publish.full_refresh_interval // 300' "$OPTIONS_PATH")
+    EXPIRE_AFTER=$(jq -r '.publish.expire_after // 0' "$OPTIONS_PATH")
 
     # 🟢 Polling
     POLL_INT=$(jq -r '.polling.poll_interval // 3' "$OPTIONS_PATH")
     DELAY_UNIT=$(jq -r '.polling.delay_between_units // 0.5' "$OPTIONS_PATH")
+    FULL_REFRESH=$(jq -r '.polling.full_refresh_cycles // 10' "$OPTIONS_PATH")
+    UNIT_INTERVALS=$(jq -r '.polling.unit_intervals // ""' "$OPTIONS_PATH")
+    CMD_DEBOUNCE=$(jq -r '.polling.command_debounce // 0.4' "$OPTIONS_PATH")
 
     #############################
     # 📌 生成 Python 用的 config.yaml
@@ -53,6 +80,9 @@ system:
   timezone_offset: ${TZ_OFFSET}
   reset_discovery_on_exit: ${RESET_ON_EXIT}
   language: "${LANGUAGE}"
+  cache_path: "${CACHE_PATH}"
+  snapshot_path: "${SNAPSHOT_PATH}"
+  engine: "${ENGINE}"
 
 blacklist:
   fail_threshold: ${FAIL_THRESHOLD}
@@ -65,7 +95,11 @@ modbus:
   port: ${MODBUS_PORT}
   unit_ids: ${SLAVE_IDS}
   timeout: ${MODBUS_TIMEOUT}
+  adaptive_timeout: ${MODBUS_ADAPTIVE}
+  min_timeout: ${MODBUS_MIN_TIMEOUT}
+  probe_timeout: ${MODBUS_PROBE_TIMEOUT}
   retry_delay: ${MODBUS_RETRY}
+  gateways: ${GATEWAYS}
 
 mqtt:
   broker: "${MQTT_HOST}"
@@ -75,10 +109,29 @@ mqtt:
   discovery_prefix: "${DISC_PREFIX}"
   node_id: "${NODE_ID}"
   device_name: "${DEVICE_NAME}"
+  state_topic_mode: "${STATE_MODE}"
+  discovery_mode: "${DISCOVERY_MODE}"
+  migrate_discovery: ${MIGRATE_DISCOVERY}
+  ha_status_topic: "${HA_STATUS_TOPIC}"
+  birth_replay_window: ${BIRTH_WINDOW}
+  publish_rate: ${PUB_RATE}
+  publish_burst: ${PUB_BURST}
+  max_inflight: ${MAX_INFLIGHT}
+
+publish:
+  deadband_voltage: ${DB_VOLT}
+  deadband_current: ${DB_CURR}
+  deadband_power: ${DB_POWER}
+  deadband_temperature: ${DB_TEMP}
+  full_refresh_interval: ${FULL_REFRESH_INT}
+  expire_after: ${EXPIRE_AFTER}
 
 polling:
   poll_interval: ${POLL_INT}
   delay_between_units: ${DELAY_UNIT}
+  full_refresh_cycles: ${FULL_REFRESH}
+  unit_intervals: "${UNIT_INTERVALS}"
+  command_debounce: ${CMD_DEBOUNCE}
 EOF
 
 else
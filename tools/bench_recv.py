@@ -0,0 +1,86 @@
+# 接收路徑微基準：舊版 data += chunk vs 新版 recv_into + memoryview
+# 用法：python3 tools/bench_recv.py [輪數] [分段數]
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from core_tcp import RobustTCPClient
+from ampinvt_proto import AmpinvtProtocol
+import language.tw as rmap
+
+def make_frame(uid, cmd, length):
+    f = bytearray([uid, cmd] + [0x11] * (length - 3))
+    f.append(sum(f) & 0xFF)
+    return bytes(f)
+
+def legacy_recv_fixed(sock, length, timeout=3.0):
+    """V8.4 的 recv_fixed (逐塊 data += chunk，每圈 time.time())"""
+    data = b''
+    start_time = time.time()
+    while len(data) < length:
+        if (time.time() - start_time) > timeout: return None
+        chunk = sock.recv(length - len(data))
+        if not chunk: return None
+        data += chunk
+    return data
+
+def responder(sock, frame, chunks=1):
+    """模擬 MPPT：收到 8 bytes 請求就回一個完整封包 (chunks > 1 時模擬閘道分段送出)"""
+    req = bytearray(8)
+    step = -(-len(frame) // chunks)
+    while True:
+        try:
+            if sock.recv_into(req) == 0: return
+            for i in range(0, len(frame), step):
+                sock.sendall(frame[i:i + step])
+                if chunks > 1: time.sleep(0.0002)
+        except OSError: return
+
+def run(label, poll_once, rounds):
+    poll_once()  # 暖身：讓預先配置的緩衝先建好
+    tracemalloc.start()
+    peak_sum = 0
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        poll_once()
+        peak_sum += tracemalloc.get_traced_memory()[1] - base
+    elapsed = time.perf_counter() - t0
+    tracemalloc.stop()
+    print(f"{label:<10} {elapsed / rounds * 1e6:8.1f} us/poll   每輪暫存配置峰值 {peak_sum / rounds:7.1f} bytes")
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    frame = make_frame(1, 0xB1, 93)
+    req = bytes([1, 0xB1, 0x01, 0, 0, 0, 0, 0xB3])
+
+    a, b = socket.socketpair()
+    threading.Thread(target=responder, args=(b, frame, chunks), daemon=True).start()
+
+    def legacy_recv():
+        a.sendall(req)
+        return legacy_recv_fixed(a, 93)
+
+    tcp = RobustTCPClient("bench", 0, 3.0)
+    tcp._attach(a)
+    proto = AmpinvtProtocol(tcp)
+    def zero_copy_recv():
+        return proto.stream.request(req, 1, (0xB1,), 93)
+
+    print(f"B1 93 bytes x {rounds} 輪，每幀分 {chunks} 段到達")
+    print("-- 只量接收路徑")
+    run("legacy", legacy_recv, rounds)
+    run("zero-copy", zero_copy_recv, rounds)
+    print("-- 接收 + decode")
+    run("legacy", lambda: proto.decode(legacy_recv(), rmap.B1_INFO), rounds)
+    run("zero-copy", lambda: proto.decode(zero_copy_recv(), rmap.B1_INFO), rounds)
+
+if __name__ == "__main__":
+    main()